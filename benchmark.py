@@ -0,0 +1,791 @@
+import argparse
+import io
+import math
+import os
+import platform
+import random
+import socket
+import ssl
+import subprocess
+import json
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import pyarrow.parquet as pq
+import requests
+from datetime import datetime
+from urllib3.util.ssl_ import create_urllib3_context
+
+import main
+import stand_in
+import synthetic
+from records import format_date, parse_date
+
+
+def self_signed_pair(folder):
+    """
+    Create a throwaway certificate and key so the benchmarks can run without Secret Manager.
+
+    Returns:
+        tuple: Paths to the certificate and key files.
+    """
+    certfile = os.path.join(folder, "cert.pem")
+    keyfile = os.path.join(folder, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-subj", "/CN=localhost", "-addext", "subjectAltName=DNS:localhost",
+         "-keyout", keyfile, "-out", certfile],
+        check=True,
+        capture_output=True,
+    )
+    return certfile, keyfile
+
+def tls_server(certfile, keyfile):
+    """
+    Start a local server that completes a mutual-TLS handshake on every connection and then hangs up.
+
+    Returns:
+        int: The port it is listening on.
+    """
+    server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_context.load_cert_chain(certfile, keyfile)
+    server_context.load_verify_locations(certfile)
+    server_context.verify_mode = ssl.CERT_REQUIRED
+
+    listener = socket.create_server(("127.0.0.1", 0))
+
+    def serve():
+        while True:
+            connection, _ = listener.accept()
+            try:
+                with server_context.wrap_socket(connection, server_side=True) as tls:
+                    tls.recv(1)
+            except (ssl.SSLError, OSError):
+                pass
+
+    threading.Thread(target=serve, daemon=True).start()
+    return listener.getsockname()[1]
+
+def handshake(context, port):
+    with socket.create_connection(("127.0.0.1", port)) as connection:
+        with context.wrap_socket(connection, server_hostname="localhost"):
+            pass
+
+def adapter_handshakes(adapter, port, connections, ca_bundle, cert=None):
+    """
+    Open connections the way a requests session does: through the adapter's pool, after cert_verify
+    has set it up, so whatever urllib3 loads per connection is paid for.
+    """
+    request = requests.Request("GET", f"https://localhost:{port}/").prepare()
+    pool = adapter.get_connection_with_tls_context(request, ca_bundle, cert)
+    adapter.cert_verify(pool, request.url, ca_bundle, cert)
+    for _ in range(connections):
+        connection = pool._new_conn()
+        connection.connect()
+        connection.close()
+
+def bench_ssl(connections, certfile=None, keyfile=None):
+    """
+    Compare mutual-TLS setup cost for the old temp-file path against the shared in-memory context.
+
+    The file path is what urllib3 does for cert=(certfile, keyfile): a new context per connection
+    that re-reads and re-parses the key from disk. The in-memory path builds one context with
+    main.load_ssl and reuses it. The requests rows make the same connections through an
+    HTTPAdapter's pool, as the ADP session does.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        if not certfile:
+            certfile, keyfile = self_signed_pair(folder)
+        with open(certfile) as f:
+            certfile_content = f.read()
+        with open(keyfile) as f:
+            keyfile_content = f.read()
+
+        port = tls_server(certfile, keyfile)
+
+        def file_context():
+            context = create_urllib3_context()
+            context.load_verify_locations(requests.certs.where())
+            context.load_verify_locations(certfile)
+            context.load_cert_chain(certfile, keyfile)
+            return context
+
+        start = time.perf_counter()
+        for _ in range(connections):
+            file_context()
+        file_setup = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(connections):
+            handshake(file_context(), port)
+        file_total = time.perf_counter() - start
+
+        start = time.perf_counter()
+        shared_context = main.load_ssl(certfile_content, keyfile_content)
+        shared_context.load_verify_locations(certfile)
+        memory_setup = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(connections):
+            handshake(shared_context, port)
+        memory_total = time.perf_counter() - start + memory_setup
+
+        start = time.perf_counter()
+        adapter_handshakes(requests.adapters.HTTPAdapter(), port, connections, certfile, (certfile, keyfile))
+        adapter_file_total = time.perf_counter() - start
+
+        start = time.perf_counter()
+        adapter = main.SSLContextAdapter(main.load_ssl(certfile_content, keyfile_content))
+        adapter_handshakes(adapter, port, connections, certfile)
+        adapter_memory_total = time.perf_counter() - start
+
+    print(f"SSL setup over {connections} connections")
+    print(f"    {'':<24}{'context setup':>16}{'setup + handshake':>20}")
+    print(f"    {'temp files (per conn)':<24}{file_setup * 1000:>14.1f}ms{file_total * 1000:>18.1f}ms")
+    print(f"    {'in memory (shared)':<24}{memory_setup * 1000:>14.1f}ms{memory_total * 1000:>18.1f}ms")
+    print(f"    {'requests, cert files':<24}{'':>16}{adapter_file_total * 1000:>18.1f}ms")
+    print(f"    {'requests, shared':<24}{'':>16}{adapter_memory_total * 1000:>18.1f}ms")
+
+    return {
+        "connections": connections,
+        "file_setup_ms": file_setup * 1000,
+        "file_total_ms": file_total * 1000,
+        "memory_setup_ms": memory_setup * 1000,
+        "memory_total_ms": memory_total * 1000,
+        "adapter_file_total_ms": adapter_file_total * 1000,
+        "adapter_memory_total_ms": adapter_memory_total * 1000,
+    }
+
+class FakeADP:
+    """
+    Stands in for main.adp, serving pre-encoded worker pages and decoding each one on request
+    as requests would.
+    """
+    def __init__(self, workers, page_size):
+        self.total = len(workers)
+        self.pages = {
+            skip: json.dumps({"workers": workers[skip:skip + page_size]}).encode("utf-8")
+            for skip in range(0, len(workers), page_size)
+        }
+
+    def get(self, api_url, params=None, headers=None):
+        response = requests.Response()
+        if params.get("count") and "$skip" not in params:
+            response.status_code = 200
+            response._content = json.dumps({"meta": {"totalNumber": self.total}}).encode("utf-8")
+        elif params.get("count") and params["$skip"] in self.pages:
+            response.status_code = 200
+            response._content = json.dumps({"meta": {"totalNumber": self.total}, **json.loads(self.pages[params["$skip"]])}).encode("utf-8")
+        elif params["$skip"] in self.pages:
+            response.status_code = 200
+            response._content = self.pages[params["$skip"]]
+        else:
+            response.status_code = 204
+            response._content = b""
+        return response
+
+def bench_memory(workers):
+    """
+    Compare peak Python memory for extracting staff by materialising every raw page first (the old
+    extractor shape) against the streaming generators GET_staff_adp uses now.
+    """
+    main.adp = FakeADP(synthetic.generate(workers, 0, 0)["workers"], 100)
+    main.Data_export = False
+    api_url = 'https://api.adp.com/hr/v2/workers'
+
+    def materialised():
+        adp_responses = list(main.fetch_pages(api_url, 100, main.count_adp(api_url)))
+        combined_staff = []
+        for item in adp_responses:
+            combined_staff.extend(item["workers"])
+        reordered_staff = list(main.transform_staff(combined_staff, []))
+        return [record for record in reordered_staff if record.status in ["Active", "Inactive"]]
+
+    def streamed():
+        return main.GET_staff_adp()
+
+    results = {"workers": workers}
+    for name, extract in (("materialised", materialised), ("streamed", streamed)):
+        with tempfile.TemporaryDirectory() as folder:
+            main.data_store = folder
+            tracemalloc.start()
+            start = time.perf_counter()
+            staff = extract()
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        results[name] = {"seconds": elapsed, "peak_mb": peak / 1024 / 1024, "records": len(staff)}
+
+    print()
+    print(f"Staff extraction peak memory over {workers} workers")
+    for name in ("materialised", "streamed"):
+        print(f"    {name:<16}{results[name]['peak_mb']:>10.1f}MB{results[name]['seconds']:>10.2f}s")
+
+    return results
+
+def bench_records(applications, seed=0):
+    """
+    Compare the memory held by transformed applications as Application records against the same
+    applications as the dicts the stages used to pass around (string dates, one dict per record).
+    """
+    raw = synthetic.generate(50, applications, 1000, broken_rate=0, seed=seed)["jobApplications"]
+    main.line_manager_name.cache_clear()
+    main.recruiter_alias.cache_clear()
+
+    results = {"applications": applications}
+    held = {}
+    for name, build in (
+        ("records", lambda: list(main.transform_applications(raw, []))),
+        ("dicts", lambda: [app.as_dict() for app in held["records"]]),
+    ):
+        tracemalloc.start()
+        held[name] = build()
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[name] = {"held_mb": current / 1024 / 1024}
+
+    print()
+    print(f"Memory held by {applications} transformed applications")
+    for name in ("records", "dicts"):
+        print(f"    {name:<16}{results[name]['held_mb']:>10.1f}MB")
+
+    return results
+
+def bench_decode(staff, applications, seed=0):
+    """
+    Compare decoding ADP pages with requests' json() against main.decode_page, with and without the
+    record_fields projection, each followed by the transform that reads the records.
+
+    CPU time is the best of three runs' process time over decoding and transforming every page; peak is the tracemalloc peak
+    of a second run, holding every decoded page as the cache, checkpoints and fetch window would.
+    """
+    payloads = synthetic.generate(staff, applications, 0, seed=seed)
+    endpoints = {
+        "workers": ("workers", lambda records: list(main.transform_staff(records, []))),
+        "job-applications": ("jobApplications", lambda records: list(main.transform_applications(records, []))),
+    }
+
+    def response_json(content, endpoint):
+        response = requests.Response()
+        response._content = content
+        response.status_code = 200
+        return response.json()
+
+    def decode_full(content, endpoint):
+        main.field_projection = False
+        try:
+            return main.decode_page(content, endpoint)
+        finally:
+            main.field_projection = True
+
+    decoders = (
+        ("json()", response_json),
+        ("orjson" if main.orjson else "json.loads", decode_full),
+        ("projected", main.decode_page),
+    )
+
+    main.Data_export = False
+    results = {"staff": staff, "applications": applications, "orjson": main.orjson is not None}
+    for endpoint, (records_key, transform) in endpoints.items():
+        _, page_size = synthetic.ENDPOINTS[records_key]
+        records = payloads[records_key]
+        pages = [json.dumps({records_key: records[skip:skip + page_size]}).encode("utf-8") for skip in range(0, len(records), page_size)]
+
+        results[endpoint] = {}
+        for name, decode in decoders:
+            def run():
+                decoded = [decode(page, endpoint) for page in pages]
+                return transform([record for page in decoded for record in page[records_key]])
+
+            cpu = None
+            for _ in range(3):                      #best of three, collector pauses make single runs noisy
+                main.line_manager_name.cache_clear()
+                main.recruiter_alias.cache_clear()
+                start = time.process_time()
+                run()
+                cpu = min(cpu or math.inf, time.process_time() - start)
+
+            tracemalloc.start()
+            run()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results[endpoint][name] = {"cpu_s": cpu, "peak_mb": peak / 1024 / 1024}
+
+    print()
+    print(f"Decoding + transform over {staff} workers / {applications} applications")
+    print(f"    {'':<34}{'CPU s':>10}{'peak MB':>10}")
+    for endpoint in endpoints:
+        for name, _ in decoders:
+            result = results[endpoint][name]
+            print(f"    {endpoint + ' ' + name:<34}{result['cpu_s']:>10.2f}{result['peak_mb']:>10.1f}")
+
+    return results
+
+def old_transform_applications(combined_applications, dead_letters_app):
+    """
+    The per-application loop GET_applicants_adp ran before transform_applications, kept as the
+    reference it is checked against. The one change is that lineManager starts empty for each
+    application: it used to carry over from the previous one when an application had no hiring
+    manager, which transform_applications deliberately no longer does.
+    """
+    reordered_applications = []
+    for apps in combined_applications:
+        try:
+            lineManager = ""
+            name = apps["applicant"]["person"]["personName"].get("formattedName","")
+            forename = apps["applicant"]["person"]["personName"].get("givenName","")
+            surname = apps["applicant"]["person"]["personName"].get("familyName1","")
+
+            app_start = apps["applicationStatusCode"].get("effectiveDate","")
+            app_dob = apps["applicant"]["person"].get("birthDate","")
+            app_status = apps["applicationStatusCode"].get("shortName","")
+            app_job = apps["jobRequisitionReference"].get("requisitionTitle","")
+            
+            hiring_manager = str(apps["jobRequisitionReference"].get("hiringManager", {}).get("personName", {}).get("formattedName",""))
+            if hiring_manager:
+                names = hiring_manager.split(", ")
+                if len(names) == 2:
+                    secondName,firstName = names
+                    lineManager = f"{firstName} {secondName}"
+                else:
+                    lineManager = ""
+
+            if lineManager == "Zacri Byam":
+                lineManager = "Zac Byam"
+            
+            recruiter = str(apps["jobRequisitionReference"].get("recruiter", {}).get("personName", {}).get("formattedName",""))
+            requisition_id = apps["jobRequisitionReference"].get("requisitionID","")
+            address = apps["applicant"]["person"]["address"].get("lineOne","")
+
+            if "Guerrero" in recruiter:
+                recruiter = "Robinson Guerrero"
+            elif "Dana" in recruiter:
+                recruiter = "Dana Schwartz"
+            elif "Schwartz" in recruiter:
+                recruiter = "Dana Schwartz"
+            elif "Julia" in recruiter:
+                recruiter = "Julia Peoples"
+            elif "Robyn" in recruiter:
+                recruiter = "Robyn Halliday"
+            
+            transformed_record = {
+                "CandidateName": name,
+                "forename": forename,
+                "surname": surname,
+                "DOB": app_dob,
+                "ApplicationStatus": app_status,
+                "JobTitle": app_job,
+                "HiringManager": hiring_manager,
+                "LineManager": lineManager,
+                "Recruiter": recruiter,
+                "Requisition_ID": requisition_id,
+                "Start Date": app_start,
+                "Address": address,
+                "Match Made": None,
+            }
+            
+            reordered_applications.append(transformed_record)
+        except Exception as e:
+            dead_letters_app.append({
+                "staff": apps,
+                "error": str(e)
+            })
+
+    return reordered_applications
+
+def malform(rng, record):
+    """
+    Break one randomly chosen field somewhere in a raw record: drop it, null it, or swap in an empty string or dict.
+    """
+    fields = []
+
+    def collect(value):
+        if isinstance(value, dict):
+            for key, below in value.items():
+                fields.append((value, key))
+                collect(below)
+
+    collect(record)
+    container, key = rng.choice(fields)
+    fault = rng.randrange(4)
+    if fault == 0:
+        del container[key]
+    else:
+        container[key] = (None, "", {})[fault - 1]
+
+def check_transform(applications, seed=0, rounds=5):
+    """
+    Check transform_applications against old_transform_applications on randomised malformed applications.
+
+    A fifth of each round's applications have one field broken by malform. Outputs are compared
+    as as_dict() gives them, with the reference's dates formatted the way the records format
+    them, and dead letters by the payload they hold and their error.
+
+    Returns:
+        int: Applications the two disagreed on, over every round.
+    """
+    mismatches = 0
+    print()
+    print(f"transform_applications against the old loop over {applications} applications")
+    for round_seed in range(seed, seed + rounds):
+        rng = random.Random(round_seed)
+        raw = synthetic.generate(50, applications, 50, seed=round_seed)["jobApplications"]
+        for record in raw:
+            if rng.random() < 0.2:
+                malform(rng, record)
+
+        expected_letters, found_letters = [], []
+        expected = old_transform_applications(raw, expected_letters)
+        for record in expected:
+            record["DOB"] = format_date(parse_date(record["DOB"]))
+            record["Start Date"] = format_date(parse_date(record["Start Date"]))
+        main.line_manager_name.cache_clear()
+        main.recruiter_alias.cache_clear()
+        found = [app.as_dict() for app in main.transform_applications(raw, found_letters)]
+
+        disagreed = abs(len(expected) - len(found)) + sum(old != new for old, new in zip(expected, found))
+        disagreed += abs(len(expected_letters) - len(found_letters)) + sum(
+            old["staff"] is not new["staff"] or old["error"] != new["error"] for old, new in zip(expected_letters, found_letters)
+        )
+        mismatches += disagreed
+        print(f"    seed {round_seed:<6}{len(found):>8} out{len(found_letters):>8} dead letters{disagreed:>8} disagreed")
+
+    return mismatches
+
+def old_match_applicants(reordered_applications, staff):
+    """
+    The applicants x staff loop match_applicants ran before build_staff_index, kept verbatim as the
+    reference find_staff_match is checked against. It reads the dicts as_dict() gives.
+    """
+    for app in reordered_applications:                          #Tries to find a matching staff member in the ADP record
+        app_forename = app.get("forename", "").lower()
+        app_surname = app.get("surname","").lower()
+        app_start_date = app.get("Start Date")
+        app_manager = app.get("Manager")
+        app_dob = app.get("DOB","")
+
+        # Flag to check if a matching record is found
+        match_found = False
+        
+        for record in staff:
+            staff_forename = record.get("Forename", "").lower()
+            staff_middlename = record.get("middleName","").lower()
+            staff_given_name = record.get("givenName","").lower
+            staff_preferred_name = record.get("preferredName","").lower
+            staff_surname = record.get("Surname", "").lower()
+            staff_status = record.get("Status", "").lower()
+            staff_hire_date = record.get("Hire Date")
+            staff_lineManager = record.get("LineManager")
+            staff_dob = record.get("BirthDate")
+
+            # Match criteria
+            matches = 0
+            if app_forename in {staff_forename, staff_middlename, staff_given_name,staff_preferred_name}:
+                matches += 1
+            if app_surname == staff_surname:
+                matches += 1
+            if app_manager == staff_lineManager:
+                matches += 1
+            
+            if app_start_date and staff_hire_date:
+                start_date = datetime.strptime(app_start_date, "%Y-%m-%d")
+                hire_date = datetime.strptime(staff_hire_date, "%Y-%m-%d")
+                if abs((start_date - hire_date).days) <= 5:
+                    matches += 1
+            
+            if app_dob == staff_dob:
+                matches +=1
+
+            # Check if two or more criteria match
+            if matches >= 3 and ("active" in staff_status or "inactive" in staff_status):
+                match_found = True
+                break
+        
+        # Set the 'Active?' field based on match
+        if match_found:
+            app["Match Made"] = True
+
+def strict_match(app, staff):
+    """
+    The "strict" match_rules as a plain loop over every staff record, the reference the strict index is checked against.
+    """
+    def agree(left, right):
+        return bool(left) and left == right
+
+    for record in staff:
+        manager = main.line_manager_name(record.manager) if record.manager else ""
+        forename = (app.forename or "").lower()
+        matches = sum((
+            any(agree(forename, (name or "").lower()) for name in (record.forename, record.middle_name, record.preferred_name)),
+            agree((app.surname or "").lower(), (record.surname or "").lower()),
+            agree(app.line_manager, manager),
+            bool(app.start_date and record.hire_date) and abs((app.start_date - record.hire_date).days) <= 5,
+            agree(app.dob, record.birth_date),
+        ))
+        staff_status = (record.status or "").lower()
+        if matches >= 3 and ("active" in staff_status or "inactive" in staff_status):
+            return True
+    return False
+
+def check_matching(staff, applications, seed=0, rounds=5):
+    """
+    Check find_staff_match against old_match_applicants on randomised synthetic staff and applications,
+    and the "strict" match_rules against strict_match, reporting which applications the strict rules
+    match differently from the legacy ones.
+
+    Each round uses its own seed, copies a fifth of the applications from workers so there are
+    matches to find, and blanks some forenames and birth dates so the old loop's empty-value
+    quirks are exercised.
+
+    Returns:
+        int: Applications either index disagreed with its reference on, over every round.
+    """
+    main.Data_export = False
+    mismatches = 0
+    print()
+    print(f"find_staff_match against the old loop over {staff} staff / {applications} applications")
+    for round_seed in range(seed, seed + rounds):
+        rng = random.Random(round_seed)
+        payloads = synthetic.generate(staff, applications, 50, hired_rate=0.2, seed=round_seed)
+        for raw in payloads["jobApplications"]:
+            person = raw["applicant"]["person"]
+            if rng.random() < 0.05:
+                person["personName"]["givenName"] = ""
+            if rng.random() < 0.05:
+                person["birthDate"] = ""
+
+        staff_records = [record for record in main.transform_staff(payloads["workers"], []) if record.status in ["Active", "Inactive"]]
+        application_records = list(main.transform_applications(payloads["jobApplications"], []))
+
+        expected = [app.as_dict() for app in application_records]
+        old_match_applicants(expected, [record.as_dict() for record in staff_records])
+        staff_index = main.build_staff_index(staff_records, "legacy")
+        found = [main.find_staff_match(app, staff_index) for app in application_records]
+        strict_index = main.build_staff_index(staff_records, "strict")
+        strict = [main.find_staff_match(app, strict_index) for app in application_records]
+
+        disagreed = sum(bool(old["Match Made"]) != new for old, new in zip(expected, found))
+        disagreed_strict = sum(new != strict_match(app, staff_records) for app, new in zip(application_records, strict))
+        mismatches += disagreed + disagreed_strict
+        gained = sum(new and not old for old, new in zip(found, strict))
+        lost = sum(old and not new for old, new in zip(found, strict))
+        print(f"    seed {round_seed:<6}legacy {sum(found):>6} matched{disagreed:>6} disagreed    "
+              f"strict {sum(strict):>6} matched{disagreed_strict:>6} disagreed{gained:>6} gained{lost:>6} lost")
+
+    return mismatches
+
+def run_stage(stage, *inputs):
+    """
+    Run a stage once for wall time, then again under tracemalloc for peak memory, so the tracing
+    overhead does not end up in the timing.
+
+    Returns:
+        tuple: The stage's output and its {"seconds", "peak_mb"} measurements.
+    """
+    main.line_manager_name.cache_clear()
+    main.recruiter_alias.cache_clear()
+    start = time.perf_counter()
+    stage(*inputs)
+    elapsed = time.perf_counter() - start
+
+    main.line_manager_name.cache_clear()
+    main.recruiter_alias.cache_clear()
+    tracemalloc.start()
+    output = stage(*inputs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return output, {"seconds": elapsed, "peak_mb": peak / 1024 / 1024}
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def bench_stages(staff, applications, requisitions, seed=0, output=None):
+    """
+    Time and memory-profile each pipeline stage over synthetic ADP payloads.
+
+    The payloads are generated and encoded as ADP pages up front, so every stage starts from the
+    same input: parse (decoding the pages), transform, matching, dedupe, filter_adp, and building
+    what reload_bigquery loads (the DataFrame of the dml path and the Arrow/Parquet of staging).
+
+    Returns:
+        dict: The run description and per-stage results, also written to output when given.
+    """
+    main.Data_export = False
+    payloads = synthetic.generate(staff, applications, requisitions, seed=seed)
+    pages = {
+        records_key: [json.dumps({records_key: records[skip:skip + page_size]}).encode("utf-8") for skip in range(0, len(records), page_size)]
+        for records_key, (_, page_size) in synthetic.ENDPOINTS.items()
+        for records in [payloads[records_key]]
+    }
+    del payloads
+
+    def parse(pages):
+        return {records_key: [record for page in encoded for record in json.loads(page)[records_key]] for records_key, encoded in pages.items()}
+
+    def transform(raw):
+        dead_letters = []
+        staff = [record for record in main.transform_staff(raw["workers"], dead_letters) if record.status in ["Active", "Inactive"]]
+        applications = list(main.transform_applications(raw["jobApplications"], dead_letters))
+        requisitions = list(main.transform_requisitions(raw["jobRequisitions"]))
+        return staff, applications, requisitions, dead_letters
+
+    def matching(applications, staff):
+        staff_index = main.build_staff_index(staff)
+        for app in applications:
+            app.match_made = True if main.find_staff_match(app, staff_index) else None
+        return applications
+
+    def dataframe(looker_data):
+        df = main.pd.DataFrame(looker_data)
+        df["RequisitionCreateDate"] = main.pd.to_datetime(df["RequisitionCreateDate"], errors="coerce")
+        df["DateofHire"] = main.pd.to_datetime(df["DateofHire"], errors="coerce")
+        return df
+
+    def arrow_table(looker_data):
+        buffer = io.BytesIO()
+        pq.write_table(main.looker_arrow(looker_data, stand_in.DASHBOARD_SCHEMA), buffer)
+        return buffer
+
+    results = {}
+
+    raw, results["parse"] = run_stage(parse, pages)
+    results["parse"].update(records_in=sum(len(encoded) for encoded in pages.values()), records_out=sum(len(records) for records in raw.values()))
+    del pages
+
+    (staff_records, application_records, requisition_records, dead_letters), results["transform"] = run_stage(transform, raw)
+    results["transform"].update(
+        records_in=sum(len(records) for records in raw.values()),
+        records_out=len(staff_records) + len(application_records) + len(requisition_records),
+        dead_letters=len(dead_letters),
+    )
+    del raw
+
+    matched, results["matching"] = run_stage(matching, application_records, staff_records)
+    results["matching"].update(records_in=len(application_records), records_out=sum(1 for app in matched if app.match_made))
+
+    deduped, results["dedupe"] = run_stage(main.dedupe_applications, matched)
+    results["dedupe"].update(records_in=len(matched), records_out=len(deduped))
+
+    looker_data, results["filter_adp"] = run_stage(main.filter_adp, deduped, requisition_records)
+    results["filter_adp"].update(records_in=len(deduped), records_out=len(looker_data))
+
+    for name, stage in (("dataframe", dataframe), ("arrow_table", arrow_table)):
+        _, results[name] = run_stage(stage, looker_data)
+        results[name].update(records_in=len(looker_data), records_out=len(looker_data))
+
+    report = {
+        "run": {
+            "staff": staff,
+            "applications": applications,
+            "requisitions": requisitions,
+            "seed": seed,
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "created": datetime.now().isoformat(timespec="seconds"),
+        },
+        "stages": results,
+    }
+
+    print()
+    print(f"Stages over {staff} staff / {applications} applications / {requisitions} requisitions")
+    print(f"    {'':<14}{'seconds':>10}{'peak MB':>10}{'in':>10}{'out':>10}")
+    for name, result in results.items():
+        print(f"    {name:<14}{result['seconds']:>10.3f}{result['peak_mb']:>10.1f}{result['records_in']:>10}{result['records_out']:>10}")
+
+    if output:
+        with open(output, "w") as outfile:
+            json.dump(report, outfile, indent=4)
+        print(f"Saved to {output}")
+
+    return report
+
+def compare(before_file, after_file):
+    """
+    Print the per-stage change in time and peak memory between two bench_stages result files.
+    """
+    with open(before_file) as file:
+        before = json.load(file)
+    with open(after_file) as file:
+        after = json.load(file)
+
+    def change(old, new):
+        return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+
+    print(f"{before_file} ({before['run']['commit']}) -> {after_file} ({after['run']['commit']})")
+    if any(before["run"][key] != after["run"][key] for key in ("staff", "applications", "requisitions", "seed")):
+        print("    warning: the two runs used different synthetic data")
+    print(f"    {'':<14}{'seconds':>20}{'':>10}{'peak MB':>20}{'':>10}")
+    for name in before["stages"]:
+        if name not in after["stages"]:
+            continue
+        old, new = before["stages"][name], after["stages"][name]
+        print(
+            f"    {name:<14}{old['seconds']:>9.3f} ->{new['seconds']:>7.3f}{change(old['seconds'], new['seconds']):>10}"
+            f"{old['peak_mb']:>9.1f} ->{new['peak_mb']:>7.1f}{change(old['peak_mb'], new['peak_mb']):>10}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the recruitment dashboard pipeline")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    ssl_parser = subparsers.add_parser("ssl", help="mutual-TLS context setup and handshake cost")
+    ssl_parser.add_argument("--connections", type=int, default=200)
+    ssl_parser.add_argument("--cert", help="PEM certificate (default: a generated self-signed one)")
+    ssl_parser.add_argument("--key", help="PEM key matching --cert")
+
+    memory_parser = subparsers.add_parser("memory", help="peak memory of materialised vs streamed extraction")
+    memory_parser.add_argument("--workers", type=int, default=5000)
+
+    records_parser = subparsers.add_parser("records", help="memory held by applications as records vs dicts")
+    records_parser.add_argument("--applications", type=int, default=200000)
+    records_parser.add_argument("--seed", type=int, default=0)
+
+    decode_parser = subparsers.add_parser("decode", help="CPU and peak memory of json() against decode_page with field projection")
+    decode_parser.add_argument("--staff", type=int, default=5000)
+    decode_parser.add_argument("--applications", type=int, default=50000)
+    decode_parser.add_argument("--seed", type=int, default=0)
+
+    stages_parser = subparsers.add_parser("stages", help="time and peak memory of each pipeline stage over synthetic data")
+    stages_parser.add_argument("--staff", type=int, default=5000)
+    stages_parser.add_argument("--applications", type=int, default=200000)
+    stages_parser.add_argument("--requisitions", type=int, default=10000)
+    stages_parser.add_argument("--seed", type=int, default=0)
+    stages_parser.add_argument("--output", help="JSON file to save the results to")
+
+    equivalence_parser = subparsers.add_parser("equivalence", help="check the rewritten stages against the loops they replaced")
+    equivalence_parser.add_argument("--staff", type=int, default=300)
+    equivalence_parser.add_argument("--applications", type=int, default=3000)
+    equivalence_parser.add_argument("--seed", type=int, default=0)
+    equivalence_parser.add_argument("--rounds", type=int, default=5)
+
+    compare_parser = subparsers.add_parser("compare", help="compare two saved stages results")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+
+    args = parser.parse_args()
+
+    if args.benchmark == "ssl":
+        bench_ssl(args.connections, args.cert, args.key)
+    elif args.benchmark == "memory":
+        bench_memory(args.workers)
+    elif args.benchmark == "records":
+        bench_records(args.applications, args.seed)
+    elif args.benchmark == "decode":
+        bench_decode(args.staff, args.applications, args.seed)
+    elif args.benchmark == "stages":
+        bench_stages(args.staff, args.applications, args.requisitions, args.seed, args.output)
+    elif args.benchmark == "equivalence":
+        mismatches = check_transform(args.applications, args.seed, args.rounds)
+        mismatches += check_matching(args.staff, args.applications, args.seed, args.rounds)
+        if mismatches:
+            raise SystemExit(1)
+    elif args.benchmark == "compare":
+        compare(args.before, args.after)
@@ -0,0 +1,90 @@
+import importlib
+import re
+import subprocess
+import sys
+import threading
+import time
+
+
+class LazyModule:
+    """
+    Stands in for a heavy module until the first attribute is read from it, then imports it.
+
+    main.py binds pandas, pyarrow and the BigQuery / Secret Manager clients this way so a cold
+    start can send its first ADP request without waiting for them. warm_up() imports them on a
+    background thread in the meantime, and whichever thread gets there first pays for the import
+    while the others wait on Python's own per-module import lock.
+    """
+    timings = {}                                    #module name -> seconds its import took, for --profile-startup
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def load(self):
+        if self.module is None:
+            start = time.perf_counter()
+            module = importlib.import_module(self.name)
+            LazyModule.timings.setdefault(self.name, time.perf_counter() - start)
+            self.module = module
+        return self.module
+
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
+
+    def __repr__(self):
+        return f"<LazyModule {self.name} ({'loaded' if self.module is not None else 'not loaded'})>"
+
+def warm_up(*modules):
+    """
+    Import the given LazyModules on a daemon thread, in order, and return the thread.
+    """
+    def load_all():
+        for module in modules:
+            try:
+                module.load()
+            except ImportError:
+                pass                                #raised again, where it can be reported, on first real use
+    thread = threading.Thread(target=load_all, name="warm-up", daemon=True)
+    thread.start()
+    return thread
+
+def import_times(statement, top=20, cwd=None):
+    """
+    Run statement in a fresh interpreter under -X importtime and collect what its imports cost.
+
+    Args:
+        statement (str): Python to run, e.g. "import main".
+        top (int): How many of the slowest imports to keep.
+        cwd (str): Folder to run in, so statement can import the modules there.
+
+    Returns:
+        list: (module, self seconds, cumulative seconds, depth) tuples, slowest cumulative first.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], capture_output=True, text=True, cwd=cwd)
+    if result.returncode != 0:
+        raise Exception(f"❌ Profiling '{statement}' failed: {result.stderr.strip().splitlines()[-1] if result.stderr.strip() else result.returncode}")
+
+    rows = []
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)", line)
+        if match:
+            own, cumulative, indent, name = match.groups()
+            rows.append((name, int(own) / 1e6, int(cumulative) / 1e6, (len(indent) - 1) // 2))
+    return sorted(rows, key=lambda row: row[2], reverse=True)[:top]
+
+def profile_startup(module_name, lazy_modules, top=20, cwd=None):
+    """
+    Print what importing module_name costs, then what each of its lazy modules costs on first use.
+    """
+    print()
+    print(f"    Import of {module_name} (python -X importtime, slowest {top}):")
+    for name, own, cumulative, depth in import_times(f"import {module_name}", top, cwd):
+        print(f"        {'  ' * depth + name:<48}{own * 1000:>9.1f}ms self{cumulative * 1000:>10.1f}ms total")
+
+    print()
+    print("    Deferred imports, loaded one after another in this process:")
+    for module in lazy_modules:
+        start = time.perf_counter()
+        module.load()
+        print(f"        {module.name:<48}{(time.perf_counter() - start) * 1000:>9.1f}ms")
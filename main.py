@@ -1,25 +1,168 @@
+import argparse
+import contextvars
+import hashlib
+import io
 import requests
 import math
 import json
 import os
-import pandas as pd
+import random
+import shutil
+import ssl
+import subprocess
+import sys
 import tempfile
-
-from datetime import datetime, timedelta
+import textwrap
+import threading
+import time
+
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from itertools import islice
 from pathlib import Path
 
 from google.auth import default
-from google.cloud import bigquery, secretmanager
 from google.auth.exceptions import DefaultCredentialsError
 from google.oauth2 import service_account
 
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:                                 #the encrypted secret cache is optional
+    Fernet = None
 
-current_folder = Path(__file__).resolve().parent
-data_store = current_folder/"Data - USA"
+try:
+    import orjson
+except ImportError:                                 #ADP pages are decoded with the json module instead
+    orjson = None
+
+from lazy import LazyModule, profile_startup, warm_up
+from metrics import RunMetrics
+from records import Application, Requisition, Staff, format_date
+
+pd = LazyModule("pandas")                           #Heavy imports wait for first use, so a cold start can reach ADP first (warm_up loads them meanwhile)
+pa = LazyModule("pyarrow")
+pc = LazyModule("pyarrow.compute")
+pq = LazyModule("pyarrow.parquet")
+bigquery = LazyModule("google.cloud.bigquery")
+secretmanager = LazyModule("google.cloud.secretmanager")
+stand_in = LazyModule("stand_in")                   #imports bigquery and pyarrow itself
 
-country = "USA"
+
+current_folder = Path(__file__).resolve().parent
+state_store = Path(os.getenv("STATE_STORE") or current_folder)     #Holds each country's data folder: snapshots, sync state, response cache, checkpoints, secrets.cache. In Cloud Run
+                                                                    #set STATE_STORE to a Cloud Storage volume mount, the container's own disk is wiped after every execution
+
+tenants = {                                         #Per country: the Secret Manager names of its ADP credentials, its BigQuery dataset and its data folder
+    "USA": {
+        "secrets": {
+            "client_id": "ADP-usa-client-id",
+            "client_secret": "ADP-usa-client-secret",
+            "keyfile": "usa_cert_key",
+            "certfile": "usa_cert_pem",
+        },
+        "dataset": "usa_recruitment_dashboard",
+        "folder": "Data - USA",
+    },
+}
+tenant_workers = 4                                  #Countries run at once by --countries, sharing the Google credentials, secret and BigQuery clients and imports
+
+country = "USA"                                     #The country a run without --countries processes
+data_store = state_store/tenants[country]["folder"]
+bigquery_project = "api-integrations-412107"
+bigquery_dataset = tenants[country]["dataset"]
+bigquery_table = "main"
+bigquery_load_mode = "staging"                      #"staging" loads a staging table and copies it over main in one atomic job, "dml" deletes every row then appends
 Data_export = False
 testing = False                                     #True uses local raw data drop, false uses API
+match_rules = "legacy"                              #"legacy" matches applicants to staff as the dashboard always has, "strict" compares managers and middle/preferred names and never lets two empty values agree (not signed off yet, benchmark.py equivalence shows the difference)
+export_format = "arrow"                             #Stage snapshots: "arrow" writes Arrow IPC files that testing mode memory-maps, "json" writes indent=4 JSON (replay falls back to whichever exists)
+snapshot_compression = None                         #Arrow IPC buffer compression: None keeps buffers mappable for zero-copy reads, "zstd" or "lz4" trade that for smaller files
+snapshot_batch_rows = 10000                         #Records per Arrow record batch, replay decodes one batch at a time
+
+adp_base_url = os.getenv("ADP_BASE_URL", "https://api.adp.com")                              #Point both at a stand_in.py server to replay recorded data (also --stand-in)
+adp_token_url = os.getenv("ADP_TOKEN_URL", "https://accounts.adp.com/auth/oauth/v2/token")
+record_exchanges = False                            #True writes every ADP exchange, cut to record_fields and scrubbed, to data_store/recordings for stand_in.py (also --record)
+
+page_workers = {                                    #Concurrent page requests per ADP endpoint
+    "workers": 8,
+    "job-applications": 16,
+    "job-requisitions": 8,
+}
+adp_pool_size = 16                                  #Keep-alive connections held open per ADP host, should be >= the largest page_workers value
+page_size_limits = {                                #Per endpoint: smallest and largest $top the governor may use, the GET_* page size is where it starts
+    "workers": (10, 100),
+    "job-applications": (5, 100),
+    "job-requisitions": (5, 100),
+}
+pagination = "first_page"                           #"first_page" reads meta.totalNumber off the first page (count=true on it), "speculative" pages ahead until a short page or 204, "count" asks for the total in a request of its own first
+adp_rate_limit = 20                                 #Most ADP requests per second, the governor halves it on a 429/5xx and creeps back up
+adp_max_attempts = 8                                #Tries per request before the run stops, rather than carrying on with a missing page
+retry_backoff = 0.5                                 #Seconds before the first retry, doubled per attempt and jittered (Retry-After wins when ADP sends one)
+retry_backoff_cap = 30                              #Longest wait between two attempts
+
+resume = False                                      #True reuses the pages an interrupted run checkpointed and fetches only the rest (also --resume)
+checkpoint_max_age = 24 * 60 * 60                   #Seconds after which an interrupted run's checkpoints are too stale to resume from
+
+task_index = int(os.getenv("CLOUD_RUN_TASK_INDEX", "0"))                    #This task of a sharded Cloud Run job, set by Cloud Run (fake all three to shard locally, or use --tasks)
+task_count = int(os.getenv("CLOUD_RUN_TASK_COUNT", "1"))                    #Tasks sharing the extraction, each fetches a disjoint slice of every endpoint's $skip ranges
+task_execution = os.getenv("CLOUD_RUN_EXECUTION")                           #Names the run, so the tasks of one execution find each other's shards
+shard_store = os.getenv("SHARD_STORE")                                      #Folder every task can reach (a Cloud Storage volume mount in Cloud Run), data_store/shards when unset
+
+full_refresh = False                                #True ignores the saved snapshots and re-pulls every record (also --full-refresh)
+delta_sync = {                                      #Per endpoint: $filter that returns records changed since the last run, and the field identifying a record. None always pulls everything
+    "workers": None,                                #terminations carry no filterable change date, so staff is always a full pull
+    "job-applications": {"filter": "applicationStatusCode/effectiveDate ge '{since}'", "key": "itemID"},
+    "job-requisitions": {"filter": "postingInstructions/postDate ge '{since}'", "key": "itemID"},
+}
+delta_overlap_days = 1                              #Re-read this many days before the high-water mark so late ADP updates are not missed
+
+server_select = True                                #Also ask ADP for just record_fields with $select, dropped for an endpoint that rejects it (off while saving raw payloads)
+field_projection = True                             #Keep only record_fields of each ADP record as pages are decoded (whole records while Data_export saves raw payloads)
+record_fields = {                                   #Per endpoint: the paths the transforms and delta sync read. True keeps everything below, lists apply their spec to each item
+    "workers": {
+        "associateOID": True,
+        "person": {
+            "legalName": {"givenName": True, "middleName": True, "familyName1": True},
+            "preferredName": {"givenName": True},
+            "birthDate": True,
+            "legalAddress": {"lineOne": True},
+        },
+        "workerStatus": {"statusCode": {"codeValue": True}},
+        "workerDates": {"originalHireDate": True},
+        "workAssignments": {"primaryIndicator": True, "reportsTo": {"reportsToWorkerName": {"formattedName": True}}},
+    },
+    "job-applications": {
+        "itemID": True,
+        "applicant": {"person": {"personName": {"formattedName": True, "givenName": True, "familyName1": True}, "birthDate": True, "address": {"lineOne": True}}},
+        "applicationStatusCode": {"effectiveDate": True, "shortName": True},
+        "jobRequisitionReference": {
+            "requisitionID": True,
+            "requisitionTitle": True,
+            "hiringManager": {"personName": {"formattedName": True}},
+            "recruiter": {"personName": {"formattedName": True}},
+        },
+    },
+    "job-requisitions": {
+        "itemID": True,
+        "postingInstructions": {"postDate": True},
+        "backfillWorkerPositions": True,
+        "openingsNewPositionQuantity": True,
+    },
+}
+
+run_report = True                                   #Write per-stage and per-endpoint metrics to data_store/run_reports after every run
+structured_logs = False                             #True also prints Cloud Logging style JSON lines on stdout (also --structured-logs)
+metrics = RunMetrics()
+
+secret_cache_ttl = 6 * 60 * 60                      #Seconds secrets stay in the encrypted local cache, only used when SECRET_CACHE_KEY holds a Fernet key
+token_refresh_margin = 5 * 60                       #Refresh the ADP bearer token this many seconds (at most a quarter of its expires_in) before it runs out
+
+response_cache = False                              #True serves repeat ADP page requests from data_store/cache (also --cache)
+cache_ttl = 12 * 60 * 60                            #Seconds a cached page is used without asking ADP, after that it is revalidated with its ETag
+cache_max_bytes = 512 * 1024 * 1024                 #Least recently used pages are evicted above this size
 
 
 def google_auth():
@@ -52,176 +195,1372 @@ def google_auth():
 
         raise Exception("❌ No valid authentication method found")
 
+secret_client = None
+secret_values = {}
+secret_lock = threading.Lock()
+secret_cache_lock = threading.Lock()
+
+def secret_manager():
+    """
+    The one Secret Manager client every secret is read through, created on first use.
+    """
+    global secret_client
+    with secret_lock:
+        if secret_client is None:
+            secret_client = secretmanager.SecretManagerServiceClient(credentials=credentials)
+        return secret_client
+
+def secret_cache():
+    key = os.getenv("SECRET_CACHE_KEY")
+    if not key or Fernet is None:
+        return None
+    return Fernet(key)
+
+def read_secret_cache(fernet):
+    cache_path = os.path.join(tenant().data_store, "secrets.cache")
+    if not os.path.exists(cache_path):
+        return {}
+    try:
+        with open(cache_path, "rb") as file:
+            return json.loads(fernet.decrypt(file.read()))
+    except (InvalidToken, ValueError):
+        return {}                                                                                                   #written with another key, or damaged
+
 def get_secrets(secret_id):
-    def access_secret_version(project_id, secret_id, version_id="latest"):
+    """
+    Read a secret, going to Secret Manager at most once per run.
 
-        client = secretmanager.SecretManagerServiceClient(credentials=credentials)
+    Values are kept in memory for the rest of the run. With SECRET_CACHE_KEY set to a Fernet key,
+    they are also kept in data_store/secrets.cache, encrypted, for secret_cache_ttl, so a warm
+    start needs no Secret Manager call at all.
+    """
+    with secret_lock:
+        if secret_id in secret_values:
+            return secret_values[secret_id]
+
+    fernet = secret_cache()
+    cached = read_secret_cache(fernet).get(secret_id) if fernet else None
+    if cached and time.time() - cached["stored"] < secret_cache_ttl:
+        secret = cached["value"]
+    else:
+        project_id = "api-integrations-412107"
+        version_id = "latest"
         name = f"projects/{project_id}/secrets/{secret_id}/versions/{version_id}"
 
-        response = client.access_secret_version(request={"name": name})
-        payload = response.payload.data.decode("UTF-8")
+        response = secret_manager().access_secret_version(request={"name": name})
+        secret = response.payload.data.decode("UTF-8")
+
+        if fernet:
+            with secret_cache_lock:
+                secrets = read_secret_cache(fernet)
+                secrets[secret_id] = {"value": secret, "stored": time.time()}
+                cache_path = os.path.join(tenant().data_store, "secrets.cache")
+                os.makedirs(tenant().data_store, exist_ok=True)
+                temp_path = f"{cache_path}.{os.getpid()}.tmp"                                                      #the tasks of a local sharded run share data_store
+                descriptor = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(descriptor, "wb") as outfile:
+                    outfile.write(fernet.encrypt(json.dumps(secrets).encode("utf-8")))
+                os.replace(temp_path, cache_path)
+
+    with secret_lock:
+        secret_values[secret_id] = secret
+    return secret
 
-        return payload
+def pem_file(content):
+    """
+    Expose PEM text as a file path without writing it to disk.
 
-    # Example usage:
-    project_id = "api-integrations-412107"
-    version_id = "latest" 
+    ssl.SSLContext.load_cert_chain only accepts paths, so on Linux (Cloud Run) the PEM is placed
+    in an anonymous in-memory file and read back through /proc. Elsewhere it falls back to a
+    temporary file that is deleted again by the caller as soon as the context has loaded it.
 
-    secret = access_secret_version(project_id, secret_id, version_id)
-    #print (secret)
-    return secret
+    Returns:
+        tuple: The path, and a function that releases it.
+    """
+    if hasattr(os, "memfd_create"):
+        fd = os.memfd_create("adp-pem")
+        try:
+            os.write(fd, content.encode('utf-8'))
+        except BaseException:
+            os.close(fd)
+            raise
+        return f"/proc/self/fd/{fd}", lambda: os.close(fd)
+
+    temp_file = tempfile.NamedTemporaryFile(delete=False)
+    temp_file.write(content.encode('utf-8'))
+    temp_file.close()
+    return temp_file.name, lambda: os.unlink(temp_file.name)
 
 def load_ssl(certfile_content, keyfile_content):
     """
-    Create temporary files for the certificate and keyfile contents.
+    Build the mutual-TLS SSL context once from the certificate and key contents.
     
     Args:
         certfile_content (str): The content of the certificate file.
         keyfile_content (str): The content of the key file.
     
     Returns:
-        tuple: Paths to the temporary certificate and key files.
+        ssl.SSLContext: Context with the client certificate loaded, shared by every ADP connection.
     """
-    # Create temporary files for certfile and keyfile
-    temp_certfile = tempfile.NamedTemporaryFile(delete=False)
-    temp_keyfile = tempfile.NamedTemporaryFile(delete=False)
+    ssl_context = ssl.create_default_context(cafile=requests.certs.where())
 
+    releases = []
     try:
-        # Write the contents into the temporary files
-        temp_certfile.write(certfile_content.encode('utf-8'))
-        temp_keyfile.write(keyfile_content.encode('utf-8'))
-        temp_certfile.close()
-        temp_keyfile.close()
-
-        # Return the paths of the temporary files
-        return temp_certfile.name, temp_keyfile.name
-    except Exception as e:
-        # Clean up in case of error
-        os.unlink(temp_certfile.name)
-        os.unlink(temp_keyfile.name)
-        raise e
-    
-def security(client_id, 
-             client_secret, 
-             temp_keyfile,
-             temp_certfile):
-        time_now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        print()
-        print ("        Creating Credentials (" + time_now + ")")
+        certfile, release_certfile = pem_file(certfile_content)
+        releases.append(release_certfile)
+        keyfile, release_keyfile = pem_file(keyfile_content)
+        releases.append(release_keyfile)
+        ssl_context.load_cert_chain(certfile, keyfile)
+    finally:
+        for release in releases:                                                                                    #whichever got made, even if the other or the load failed
+            release()
+
+    return ssl_context
+
+class SSLContextAdapter(requests.adapters.HTTPAdapter):
+    """
+    HTTPAdapter that hands the same prebuilt SSLContext to every pooled connection, instead of
+    urllib3 building a context and re-reading the certificate files for each new connection.
 
-        def adp_bearer():
-            adp_token_url = 'https://accounts.adp.com/auth/oauth/v2/token'                                                                                          
+    The context already trusts requests' CA bundle, and any other bundle requests is told to
+    verify with (session.verify, REQUESTS_CA_BUNDLE) is loaded into it once. The bundle is then
+    kept off the connection pool, as urllib3 would load it into the shared context again on
+    every new connection.
+    """
+    def __init__(self, ssl_context, **kwargs):
+        self.ssl_context = ssl_context
+        self.ca_lock = threading.Lock()
+        self.ca_loaded = set()
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["ssl_context"] = self.ssl_context
+        return super().init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, *args, **kwargs):
+        kwargs["ssl_context"] = self.ssl_context
+        return super().proxy_manager_for(*args, **kwargs)
+
+    def cert_verify(self, conn, url, verify, cert):
+        super().cert_verify(conn, url, verify, cert)
+        if not (url.lower().startswith("https") and verify):
+            return
+        if verify is not True:
+            with self.ca_lock:
+                if verify not in self.ca_loaded:
+                    if os.path.isdir(verify):
+                        self.ssl_context.load_verify_locations(capath=verify)
+                    else:
+                        self.ssl_context.load_verify_locations(cafile=verify)
+                    self.ca_loaded.add(verify)
+        conn.ca_certs = None
+        conn.ca_cert_dir = None
+
+def adp_client(ssl_context):
+    """
+    Create the pooled HTTP session shared by every ADP call.
+
+    The session holds the client certificate and keeps connections alive, so the mutual-TLS
+    handshake happens once per pooled connection instead of once per request.
+
+    Args:
+        ssl_context (ssl.SSLContext): The context built by load_ssl, or None for a plain-HTTP stand-in.
+
+    Returns:
+        requests.Session: The session, ready for security() to add the bearer token.
+    """
+    session = requests.Session()
+    if ssl_context is None:
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=adp_pool_size)
+        session.mount("http://", adapter)
+    else:
+        adapter = SSLContextAdapter(ssl_context, pool_connections=2, pool_maxsize=adp_pool_size)
+        session.mount("https://", adapter)
+    session.verify = True
+    session.headers["Accept-Encoding"] = "gzip"                                                                     #requests decompresses it, adp_get records both sizes
+
+    if record_exchanges:
+        session.hooks["response"].append(stand_in.ExchangeRecorder(os.path.join(tenant().data_store, "recordings"), record_fields))
+
+    return session
+
+class AdpBearer(requests.auth.AuthBase):
+    """
+    Bearer auth for the ADP session that fetches its own token and refreshes it before it expires.
+
+    A new token is requested token_refresh_margin seconds (at most a quarter of expires_in)
+    before it runs out, and once more if ADP answers 401 anyway. The lock means page workers that
+    all notice at once share one refresh. The token call is paced and retried like any other.
+    """
+    def __init__(self, client_id, client_secret, session):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.session = session
+        self.lock = threading.Lock()
+        self.access_token = None
+        self.expires_at = 0
+        self.margin = token_refresh_margin
+
+    def refresh(self, rejected_token=None):
+        """
+        Return a token that is good for at least its refresh margin more seconds.
+
+        Args:
+            rejected_token (str): A token ADP has just refused, which is replaced even if it has not expired.
+        """
+        with self.lock:
+            if self.access_token and self.access_token != rejected_token and time.monotonic() < self.expires_at - self.margin:
+                return self.access_token
 
             adp_token_data = {
                 'grant_type': 'client_credentials',
-                'client_id': client_id,
-                'client_secret': client_secret
+                'client_id': self.client_id,
+                'client_secret': self.client_secret
             }
             adp_headers = {
                 'Content-Type': 'application/x-www-form-urlencoded',
             }
 
-
-            adp_token_response = requests.post(adp_token_url, 
-                                                cert=(temp_certfile, temp_keyfile), 
-                                                verify=True, 
+            adp_token_response = adp_send("token", lambda: self.session.post(adp_token_url, 
                                                 data=adp_token_data, 
-                                                headers=adp_headers)
+                                                headers=adp_headers,
+                                                auth=lambda request: request))                                  #the token call itself goes without a bearer
+
+            if adp_token_response.status_code != 200:
+                raise Exception(f"❌ ADP token request failed. Status code: {adp_token_response.status_code}")
+
+            token = adp_token_response.json()
+            self.access_token = token['access_token']
+            expires_in = float(token.get('expires_in') or 3600)
+            self.expires_at = time.monotonic() + expires_in
+            self.margin = min(token_refresh_margin, expires_in / 4)                                                 #a short-lived token would otherwise never count as fresh
+            return self.access_token
+
+    def __call__(self, request):
+        request.headers['Authorization'] = f'Bearer {self.refresh()}'
+        request.register_hook("response", self.retry_unauthorised)
+        return request
+
+    def retry_unauthorised(self, response, **kwargs):
+        if response.status_code != 401:                                                                             #the retry below is sent past the session, so it never comes back here
+            return response
+
+        rejected_token = response.request.headers.get('Authorization', '').removeprefix('Bearer ')
+        access_token = self.refresh(rejected_token)
+        response.content
+        response.close()
+
+        retry = response.request.copy()
+        retry.headers['Authorization'] = f'Bearer {access_token}'
+        retried = response.connection.send(retry, **kwargs)
+        retried.history.append(response)
+        retried.request = retry
+        return retried
+
+def security(client_id, 
+             client_secret, 
+             session):
+        time_now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print()
+        print ("        Creating Credentials (" + time_now + ")")
 
-            if adp_token_response.status_code == 200:
-                access_token = adp_token_response.json()['access_token']
+        bearer = AdpBearer(client_id, client_secret, session)
+        access_token = bearer.refresh()
 
-            return access_token
-    
-        access_token = adp_bearer()
+        session.auth = bearer
+        session.headers.update({
+            'Accept':"application/json;masked=false",
+        })
 
         return access_token
 
-def GET_staff_adp():
-    current_date = datetime.now()                                      
-    months = current_date - timedelta(days=500)
-    formatted_date = months.strftime("%Y-%m-%d")
+class AdpGovernor:
+    """
+    Paces every ADP request through one shared token bucket, with a concurrency limit and an
+    adaptive $top per endpoint.
+
+    A 429 pauses all requests for Retry-After and halves the request rate. A 429, 5xx or dropped
+    connection also halves the endpoint's concurrency and page size. Each success wins back a
+    twentieth of adp_rate_limit and, once per round of requests, one more concurrent request up to
+    page_workers. The page size doubles while ADP returns full pages and request latency stays
+    flat, and stops at the largest page ADP actually returns. With response_cache on the page size
+    stays where the GET_* call started it, so a rerun asks for the same pages and hits the cache.
+    """
+    def __init__(self, rate, min_rate=0.5):
+        self.condition = threading.Condition()
+        self.local = threading.local()
+        self.rate = self.max_rate = rate
+        self.min_rate = min_rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.endpoints = {}
+
+    def register(self, endpoint, page_size, workers, implicit=False):
+        """
+        Set up an endpoint the first time it is fetched; later calls keep what has been learned.
+        Endpoints first seen by acquire (e.g. a count=true call) are set up properly once fetch_pages registers them.
+        """
+        with self.condition:
+            if endpoint not in self.endpoints or (self.endpoints[endpoint]["implicit"] and not implicit):
+                active = self.endpoints[endpoint]["active"] if endpoint in self.endpoints else 0
+                smallest, largest = page_size_limits.get(endpoint, (page_size, page_size))
+                self.endpoints[endpoint] = {
+                    "page_size": min(max(page_size, smallest), largest),
+                    "min_page_size": smallest,
+                    "max_page_size": largest,
+                    "workers": workers,
+                    "limit": workers,
+                    "active": active,
+                    "implicit": implicit,
+                    "successes": 0,
+                    "latency_ms": None,
+                    "samples": 0,
+                    "previous_latency_ms": None,
+                }
+            return self.endpoints[endpoint]
+
+    def page_size(self, endpoint):
+        with self.condition:
+            return self.endpoints[endpoint]["page_size"]
+
+    def acquire(self, endpoint):
+        """
+        Block until the bucket has a token, no pause is in force and the endpoint is under its concurrency limit.
+        """
+        with self.condition:
+            if endpoint not in self.endpoints:
+                self.register(endpoint, 1, 1, implicit=True)
+            while True:
+                state = self.endpoints[endpoint]
+                now = time.monotonic()
+                self.tokens = min(self.max_rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now < self.paused_until:
+                    self.condition.wait(self.paused_until - now)
+                elif state["active"] >= state["limit"]:
+                    self.condition.wait()
+                elif self.tokens < 1:
+                    self.condition.wait((1 - self.tokens) / self.rate)
+                else:
+                    self.tokens -= 1
+                    state["active"] += 1
+                    return
+
+    def release(self, endpoint, status_code, seconds, retry_after=None):
+        """
+        Hand back a request slot and adjust to how ADP answered (status_code None for a connection error).
+        """
+        self.local.seconds = seconds                                                                                  #page_result runs on the same thread and reads this
+        with self.condition:
+            state = self.endpoints[endpoint]
+            state["active"] -= 1
+            if status_code == 429:
+                try:
+                    pause = float(retry_after)
+                except (TypeError, ValueError):
+                    pause = 1.0
+                self.paused_until = max(self.paused_until, time.monotonic() + pause)
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.tokens = min(self.tokens, 1)
+            if status_code is None or status_code == 429 or status_code >= 500:
+                state["limit"] = max(1, state["limit"] // 2)
+                if not response_cache:
+                    state["page_size"] = max(state["min_page_size"], state["page_size"] // 2)
+                state["successes"] = 0
+                state["latency_ms"], state["samples"], state["previous_latency_ms"] = None, 0, None
+            else:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+                state["successes"] += 1
+                if state["successes"] % state["limit"] == 0:
+                    state["limit"] = min(state["workers"], state["limit"] + 1)
+            self.condition.notify_all()
+
+    def page_result(self, endpoint, requested, received, more):
+        """
+        Learn from the page this thread just fetched: a short page with more records still to come
+        is ADP's cap on $top, and full pages at a flat latency mean the page size can grow.
+
+        Args:
+            endpoint (str): The endpoint.
+            requested (int): The $top asked for.
+            received (int): Records that came back.
+            more (bool): Whether records remained beyond this page.
+        """
+        if response_cache:
+            return                                                                                                  #cached pages are keyed on $top, and a hit's latency says nothing about ADP
+        with self.condition:
+            state = self.endpoints[endpoint]
+            if more and 0 < received < requested:
+                state["max_page_size"] = max(state["min_page_size"], received)
+                state["page_size"] = min(state["page_size"], state["max_page_size"])
+                return
+            if received < requested or requested != state["page_size"]:
+                return
+
+            latency_ms = getattr(self.local, "seconds", 0) * 1000
+            state["latency_ms"] = latency_ms if state["latency_ms"] is None else 0.8 * state["latency_ms"] + 0.2 * latency_ms
+            state["samples"] += 1
+            if state["samples"] < 3:
+                return
+
+            previous = state["previous_latency_ms"]
+            if previous is not None and state["latency_ms"] > 1.5 * previous:
+                state["max_page_size"] = state["page_size"]                                                           #latency grew with the page, so bigger pages stop paying
+            elif state["page_size"] < state["max_page_size"]:
+                state["previous_latency_ms"] = state["latency_ms"]
+                state["page_size"] = min(state["max_page_size"], state["page_size"] * 2)
+                state["latency_ms"], state["samples"] = None, 0
+
+governor = AdpGovernor(adp_rate_limit)
+adp = None                                                                                                          #the ADP session, set once security() has its token
+
+class Tenant:
+    """
+    What one country's run keeps to itself when run_tenants runs several in one process: its
+    data folder, BigQuery dataset, ADP session, governor (each country is its own ADP account,
+    with its own rate limit) and metrics. reducing is set while it reads a sharded run's shards
+    back instead of calling ADP.
 
-    time_now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print()
-    print ("Retrieving Current Staff from ADP Workforce Now (" + time_now + ")")
-    api_url = 'https://api.adp.com/hr/v2/workers'
-    api_headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Accept':"application/json;masked=false",  
-        }
+    Code reads these through tenant(). Outside run_tenants that is the module-level configuration,
+    so a single-country run, benchmark.py and anything assigning main.data_store work as before.
+    """
+    def __init__(self, country, data_store, dataset, adp=None, governor=None, metrics=None):
+        self.country = country
+        self.data_store = data_store
+        self.dataset = dataset
+        self.adp = adp
+        self.governor = governor
+        self.metrics = metrics
+        self.reducing = False
+
+    @classmethod
+    def configured(cls, country):
+        """
+        A fresh tenant for a country in tenants, with a governor and metrics of its own.
+        """
+        if country not in tenants:
+            raise Exception(f"❌ No tenant configured for {country}, expected one of: {', '.join(tenants)}")
+        config = tenants[country]
+        return cls(country, state_store/config["folder"], config["dataset"],
+                   governor=AdpGovernor(adp_rate_limit), metrics=RunMetrics(structured_logs, {"country": country, **({"task_index": task_index} if task_count > 1 else {})}))
+
+active_tenant = contextvars.ContextVar("active_tenant", default=None)
+
+def tenant():
+    """
+    The tenant this code is running for: the one run_tenants made active, else the module-level configuration.
+    """
+    return active_tenant.get() or Tenant(country, data_store, bigquery_dataset, adp, governor, metrics)
+
+def backoff_delay(attempt):
+    """
+    Seconds to wait before retry number `attempt`: exponential with full jitter, so workers that
+    failed together do not all come back at the same moment.
+    """
+    return random.uniform(0, min(retry_backoff_cap, retry_backoff * 2 ** (attempt - 1)))
+
+def wire_bytes(api_response):
+    """
+    Bytes of the response body as sent, before requests undid any Content-Encoding.
+    """
+    try:
+        return api_response.raw.tell()                                                                              #urllib3 counts what it read off the socket
+    except AttributeError:
+        return len(api_response.content)
+
+def select_paths(fields, prefix):
+    """
+    Turn a record_fields spec into ADP $select paths, e.g. "workers/person/legalName/givenName".
+    """
+    for key, below in fields.items():
+        path = f"{prefix}/{key}"
+        if below is True:
+            yield path
+        else:
+            yield from select_paths(below, path)
+
+def json_loads(data):
+    """
+    Decode JSON text or bytes with orjson when it is installed, otherwise with the json module.
+    """
+    return orjson.loads(data) if orjson else json.loads(data)
+
+def field_picker(fields):
+    """
+    Compile a record_fields spec into a function that copies just those parts of a record.
+
+    Keys the spec names but a record lacks stay missing, so a transform still fails on a record
+    missing a required block as it would on the full record. The spec is walked once here, so
+    per record only the named keys are looked up.
+
+    Returns:
+        function: The picker, or None for True (keep everything).
+    """
+    if fields is True:
+        return None
+    children = tuple((key, field_picker(below)) for key, below in fields.items())
+
+    def pick(value):
+        if type(value) is dict:
+            picked = {}
+            for key, child in children:
+                if key in value:
+                    picked[key] = value[key] if child is None else child(value[key])
+            return picked
+        if type(value) is list:
+            return [pick(item) for item in value]
+        return value
+
+    return pick
+
+@lru_cache(maxsize=None)
+def record_picker(endpoint):
+    return field_picker(record_fields[endpoint]) if endpoint in record_fields else None
+
+def decode_page(content, endpoint):
+    """
+    Decode an ADP response body, cutting every record in it down to the endpoint's record_fields.
+
+    Returns:
+        dict: The page, with its record list(s) projected and anything else (meta) left as it came.
+    """
+    page = json_loads(content)
+    picker = record_picker(endpoint) if field_projection and not Data_export else None
+    if picker and isinstance(page, dict):
+        for key, value in page.items():
+            if isinstance(value, list):
+                page[key] = [picker(record) for record in value]
+    return page
+
+def adp_send(endpoint, send):
+    """
+    Make one ADP request through the governor, trying it again after a jittered exponential
+    backoff when it is throttled (429), fails (5xx), is dropped or its body is cut off, up to
+    adp_max_attempts. The governor gets its slot back even when send() raises something else.
+
+    Args:
+        endpoint (str): What the governor and metrics file the request under.
+        send (callable): Sends the request and returns the response.
+
+    Returns:
+        requests.Response: The first response that is not a 429 or 5xx, or the last one.
+    """
+    for attempt in range(1, adp_max_attempts + 1):
+        tenant().governor.acquire(endpoint)
+        start = time.perf_counter()
+        api_response = None
+        try:
+            api_response = send()                                                                                   #reads the whole body, so a cut-off transfer fails here
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError, requests.exceptions.ContentDecodingError):
+            if attempt == adp_max_attempts:
+                raise
+        finally:
+            seconds = time.perf_counter() - start                                                                   #the slot goes back whatever send() raised, or the endpoint stalls
+            if api_response is None:
+                tenant().governor.release(endpoint, None, seconds)
+            else:
+                tenant().governor.release(endpoint, api_response.status_code, seconds, api_response.headers.get("Retry-After"))
+        if api_response is None:
+            tenant().metrics.retry(endpoint)
+            time.sleep(backoff_delay(attempt))
+            continue
+
+        tenant().metrics.request(endpoint, seconds, api_response.status_code, len(api_response.content), wire_bytes(api_response))
+        if (api_response.status_code != 429 and api_response.status_code < 500) or attempt == adp_max_attempts:
+            return api_response
+        tenant().metrics.retry(endpoint)
+        if "Retry-After" not in api_response.headers:                                                            #the governor is already holding every request for Retry-After
+            time.sleep(backoff_delay(attempt))
+
+def adp_get(api_url, api_params):
+    """
+    GET an ADP endpoint, going through the on-disk response cache when response_cache is on.
+
+    Cached responses are stored in data_store/cache under a hash of the URL and query parameters.
+    Within cache_ttl they are returned without a request. After that they are revalidated with
+    If-None-Match when ADP sent an ETag, and a 304 keeps the cached body.
+
+    Requests go through adp_send, so the governor and its retries.
+
+    Returns:
+        tuple: The status code, and the body decoded by decode_page for a 200 (otherwise None).
+    """
+    endpoint = api_url.rstrip("/").rsplit("/", 1)[-1]
+
+    def timed_get(headers=None):
+        return adp_send(endpoint, lambda: tenant().adp.get(api_url, params=api_params, headers=headers))
+
+    def decoded(api_response):
+        page = decode_page(api_response.content, endpoint)
+        if isinstance(page, dict):
+            tenant().metrics.page(endpoint, sum(len(value) for value in page.values() if isinstance(value, list)))
+        return page
+
+    if not response_cache:
+        api_response = timed_get()
+        return api_response.status_code, decoded(api_response) if api_response.status_code == 200 else None
+
+    fields = record_fields.get(endpoint) if field_projection and not Data_export else None
+    key = hashlib.sha256(json.dumps([api_url, sorted(api_params.items()), fields], default=str).encode("utf-8")).hexdigest()          #a projected page is only reused under the same projection
+    cache_path = os.path.join(tenant().data_store, "cache", f"{key}.json")
+
+    cached = None
+    try:
+        with open(cache_path, "rb") as file:
+            cached = json_loads(file.read())
+    except FileNotFoundError:
+        cached = None                                                                                               #never cached, or evicted by another endpoint's fetch
+    except ValueError:
+        cached = None                                                                                               #half-written by a killed run, treat as a miss
+
+    if cached and time.time() - cached["stored"] < cache_ttl:
+        try:
+            os.utime(cache_path)                                                                                    #mtime doubles as the LRU clock
+        except FileNotFoundError:
+            pass
+        tenant().metrics.cache_hit(endpoint)
+        return cached["status_code"], cached["body"]
+
+    headers = {"If-None-Match": cached["etag"]} if cached and cached.get("etag") else None
+    api_response = timed_get(headers)
+
+    if api_response.status_code == 304 and cached:
+        tenant().metrics.cache_hit(endpoint)
+        status_code, body, etag = cached["status_code"], cached["body"], cached["etag"]
+    elif api_response.status_code in (200, 204):
+        status_code = api_response.status_code
+        body = decoded(api_response) if status_code == 200 else None
+        etag = api_response.headers.get("ETag")
+    else:
+        return api_response.status_code, None
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    temp_path = f"{cache_path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    with open(temp_path, "w") as outfile:
+        json.dump({"url": api_url, "params": api_params, "stored": time.time(), "etag": etag, "status_code": status_code, "body": body}, outfile)
+    os.replace(temp_path, cache_path)
+
+    return status_code, body
+
+def evict_cache():
+    """
+    Delete the least recently used cached responses until the cache fits in cache_max_bytes.
+
+    Endpoints finish fetching side by side, so a file may already be gone when it is looked at or removed.
+    """
+    cache_folder = os.path.join(tenant().data_store, "cache")
+    if not response_cache or not os.path.isdir(cache_folder):
+        return
+
+    entries = []
+    for entry in os.scandir(cache_folder):
+        if entry.name.endswith(".json"):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    cache_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if cache_size <= cache_max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        cache_size -= size
+
+def count_adp(api_url, api_params=None):
     api_count_params = {
+            **(api_params or {}),
             "count": "true",
         }
 
-    api_count_response = requests.get(api_url, cert=(temp_certfile, temp_keyfile), verify=True, headers=api_headers, params=api_count_params)                 #data request. Find number of records and uses this to find the pages needed
-    response_data = api_count_response.json()
+    status_code, response_data = adp_get(api_url, api_count_params)                                                                                                  #data request. Find number of records and uses this to find the pages needed
+    if status_code == 400:
+        return None
+    if status_code != 200:
+        raise Exception(f"❌ Failed to count {api_url} from API, status code {status_code}")
     total_number = response_data.get("meta", {}).get("totalNumber", 0)
-    rounded_total_number = math.ceil(total_number / 100) * 100
 
-    adp_responses = []                                                                                                                              # Initialize an empty list to store API responses. This will also store the outputted data
+    return total_number
 
-    def make_api_request_active(skip_param):                                                                                                        # Function to make an API request with skip_param and append the response to all_responses
+def first_adp_page(api_url, page_size, api_params=None):
+    """
+    Fetch the first page of an endpoint and find out how many records there are, as pagination says.
 
-        api_headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Accept':"application/json;masked=false"
-            }
- 
-        api_params = {
-            "$top": 100,
-            "$skip": skip_param,
-            }
+    "first_page" sends count=true with the first page, so ADP returns meta.totalNumber alongside its
+    records. "speculative" leaves the total unknown and fetch_pages reads ahead until the data runs
+    out. "count" is the old separate count=true request, with no first page.
 
-        api_response = requests.get(api_url, cert=(temp_certfile, temp_keyfile), verify=True, headers=api_headers, params=api_params)
+    Returns:
+        tuple: (total_number, first_page). total_number is None when it is not known up front (or ADP
+            left meta out). first_page is ($top, decoded page or None for a 204), or None when not fetched.
+            None instead of a tuple when ADP refused the request with a 400, e.g. a $filter or $select it
+            does not support.
+
+    Raises:
+        Exception: For any other failure (a 401, or a 429/5xx that outlasted adp_send's retries), so
+            a transient error is not mistaken for ADP refusing the query.
+    """
+    endpoint = api_url.rstrip("/").rsplit("/", 1)[-1]
+    tenant().governor.register(endpoint, page_size, page_workers.get(endpoint, 1))
+
+    if pagination == "count":
+        total_number = count_adp(api_url, api_params)
+        if total_number is None:
+            return None
+        return total_number or None, None                                                                           #no total reported, page until the data runs out
+
+    top = tenant().governor.page_size(endpoint)
+    first_params = {**(api_params or {}), "$top": top, "$skip": 0}
+    if pagination == "first_page":
+        first_params["count"] = "true"
+
+    status_code, json_data = adp_get(api_url, first_params)
+    if status_code == 204:
+        return 0, (top, None)
+    if status_code == 400:
+        return None
+    if status_code != 200:
+        raise Exception(f"❌ Failed to retrieve the first page of {endpoint} from API, status code {status_code}")
+    return json_data.get("meta", {}).get("totalNumber"), (top, json_data)
+
+def get_adp_page(api_url, page_size, skip_param, api_params=None):
+    """
+    Request a single page of an ADP endpoint.
 
-        if api_response.status_code == 200:
-            #checks the response and writes the response to a variable
-            json_data = api_response.json()
+    Returns:
+        dict: The decoded page, or None when ADP returned 204.
 
-            # Append the response to all_responses
-            adp_responses.append(json_data)
+    Raises:
+        Exception: ADP still refused the page after adp_max_attempts, so the run stops rather than losing it.
+    """
+    api_params = {
+        **(api_params or {}),
+        "$top": page_size,
+        "$skip": skip_param,
+        }
+
+    status_code, json_data = adp_get(api_url, api_params)
+
+    if status_code == 200:
+        return json_data
+    elif status_code == 204:
+        return None
+    else:
+        raise Exception(f"❌ Failed to retrieve data from API for skip_param {skip_param}. Status code: {status_code}")
+
+def checkpoint_root():
+    """
+    Where this run keeps its checkpoints, one folder per task when sharded so local tasks sharing data_store keep apart.
+    """
+    root = os.path.join(tenant().data_store, "checkpoints")
+    return os.path.join(root, f"task-{task_index}") if task_count > 1 else root
+
+def open_checkpoints(endpoint, api_params, total_number, start=0, stop=None):
+    """
+    Get an endpoint's checkpoint folder ready for a fetch.
+
+    With resume set, pages from an interrupted run are kept when it asked for the same parameters
+    and $skip slice and is younger than checkpoint_max_age. Otherwise the folder is emptied and a
+    new manifest written.
+
+    Returns:
+        tuple: The folder, and {$skip: $top} of the ranges already checkpointed.
+    """
+    folder = os.path.join(checkpoint_root(), endpoint)
+    manifest_path = os.path.join(folder, "manifest.json")
+
+    if resume and os.path.exists(manifest_path):
+        with open(manifest_path, "r") as file:
+            manifest = json.load(file)
+        if (manifest["api_params"] == (api_params or {}) and manifest.get("range", [0, None]) == [start, stop]
+                and time.time() - manifest["created"] < checkpoint_max_age):
+            ranges = {}
+            for entry in os.scandir(folder):
+                if entry.name.endswith(".json") and entry.name != "manifest.json":
+                    skip_param, top = entry.name[:-len(".json")].split("-")
+                    ranges[int(skip_param)] = int(top)
+            if manifest["total_number"] != total_number:
+                print(f"           {endpoint} now has {total_number} records, {manifest['total_number']} when checkpointed")
+            print(f"           Resuming {endpoint} from {len(ranges)} checkpointed pages")
+            return folder, ranges
+
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+    with open(manifest_path, "w") as outfile:
+        json.dump({"api_params": api_params or {}, "range": [start, stop], "total_number": total_number, "created": time.time()}, outfile)
+    return folder, {}
+
+def write_checkpoint(folder, skip_param, top, page):
+    checkpoint_path = os.path.join(folder, f"{skip_param}-{top}.json")
+    with open(f"{checkpoint_path}.tmp", "w") as outfile:
+        json.dump(page, outfile)
+    os.replace(f"{checkpoint_path}.tmp", checkpoint_path)                                                          #a page is either fully checkpointed or not at all
+
+def read_checkpoint(folder, skip_param, top):
+    with open(os.path.join(folder, f"{skip_param}-{top}.json"), "rb") as file:
+        return json_loads(file.read())
+
+def clear_checkpoints():
+    """
+    Delete every checkpoint once a run has finished, so the next --resume has nothing stale to pick up.
+    """
+    shutil.rmtree(checkpoint_root(), ignore_errors=True)
 
-            # Check for a 204 status code and break the loop
-            if api_response.status_code == 204:
-                return True
-        elif api_response.status_code == 204:
-            return True
+def fetch_pages(api_url, page_size, total_number=None, api_params=None, first_page=None, start=0, stop=None):
+    """
+    Fetch every page of an ADP endpoint through a bounded worker pool.
+
+    At most two pages per worker are requested ahead of the consumer, so only a handful of raw
+    pages are held in memory however large the endpoint is.
+
+    Each page's $top is whatever the governor has settled on when it is scheduled. If ADP returns
+    fewer records than asked for before the end of the data, the rest of that range is requested
+    straight away, so a capped $top never leaves a gap.
+
+    With the total known, pages stop at the last record. Without it, pages are requested ahead until
+    one comes back empty (a 204), and ranges past that point are dropped without a request. The
+    read-ahead starts at two pages and doubles with every full one, so a small endpoint is barely
+    overshot. A short page cannot be told apart from a capped $top then, so the rest of its range
+    is asked for once.
+
+    Every fetched range is checkpointed to data_store/checkpoints/<endpoint>. With resume set, the
+    ranges an interrupted run already checkpointed are read back from disk, and only the gaps
+    between them are requested.
+
+    start and stop limit the fetch to one task's slice of the $skip ranges in a sharded run.
+
+    Args:
+        api_url (str): The ADP endpoint.
+        page_size (int): The $top to start from.
+        total_number (int): meta.totalNumber, or None when it is not known.
+        api_params (dict): Extra query parameters sent with every page, e.g. a $filter.
+        first_page (tuple): ($top, page) already fetched for $skip 0 by first_adp_page.
+        start (int): The first $skip to fetch.
+        stop (int): The $skip to stop before, or None for the end of the data.
+
+    Yields:
+        dict: The decoded pages in $skip order (204s are left out).
+    """
+    endpoint = api_url.rstrip("/").rsplit("/", 1)[-1]
+    workers = page_workers.get(endpoint, 1)
+    tenant().governor.register(endpoint, page_size, workers)
+    checkpoint_folder, checkpointed = open_checkpoints(endpoint, api_params, total_number, start, stop)
+    checkpoint_starts = sorted(checkpointed)
+    if 0 in checkpointed:
+        first_page = None                                                                                          #the checkpoint wins, it lines up with the ranges after it
+    end = [total_number]                                                                                            #where the data stops, found by the fetches when not known up front
+
+    def ranges():
+        skip_param = start
+        while (end[0] is None or skip_param < end[0]) and (stop is None or skip_param < stop):
+            if skip_param in checkpointed:
+                top = checkpointed[skip_param]
+                yield skip_param, top, True
+            else:
+                top = first_page[0] if skip_param == 0 and first_page else tenant().governor.page_size(endpoint)
+                following = bisect_right(checkpoint_starts, skip_param)
+                if following < len(checkpoint_starts):
+                    top = min(top, checkpoint_starts[following] - skip_param)                                  #stop at the next checkpointed range
+                if stop is not None:
+                    top = min(top, stop - skip_param)                                                               #and at the end of this task's slice
+                yield skip_param, top, False
+            skip_param += top
+
+    def fetch(skip_param, top, from_checkpoint):
+        if from_checkpoint:
+            tenant().metrics.checkpoint_hit(endpoint)
+            return skip_param, top, read_checkpoint(checkpoint_folder, skip_param, top)
+        if end[0] is not None and skip_param >= end[0]:
+            return skip_param, top, None                                                                            #read ahead past the end of the data
+
+        page = None
+        received = 0
+        short = None                                                                                                #a short part, cap or end, settled by the next request
+        while received < top:
+            requested = top - received
+            if skip_param == 0 and received == 0 and first_page:
+                part = first_page[1]
+            else:
+                part = get_adp_page(api_url, requested, skip_param + received, api_params)
+            records = next((value for value in part.values() if isinstance(value, list)), []) if part else []
+            if short:
+                tenant().governor.page_result(endpoint, *short, bool(records))
+                short = None
+            if total_number is not None:
+                more = skip_param + received + len(records) < total_number
+                tenant().governor.page_result(endpoint, requested, len(records), more)
+            elif 0 < len(records) < requested:
+                more, short = True, (requested, len(records))
+            else:
+                more = bool(records)
+                tenant().governor.page_result(endpoint, requested, len(records), more)
+            if not records:
+                if total_number is None:
+                    end[0] = min(skip_param + received, end[0] if end[0] is not None else math.inf)
+                break
+            if page is None:
+                page = part
+            else:
+                next(value for value in page.values() if isinstance(value, list)).extend(records)
+            received += len(records)
+            if not more:
+                break
+
+        write_checkpoint(checkpoint_folder, skip_param, top, page)
+        return skip_param, top, page
+
+    skips = ranges()
+    window = workers * 2 if total_number is not None else 2                                                        #with no total, read ahead slowly at first so a small endpoint is not overshot
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight = deque(pool.submit(contextvars.copy_context().run, fetch, *skip) for skip in islice(skips, window))    #each page runs in the caller's context, so for its tenant
+        while in_flight:
+            skip_param, top, page = in_flight.popleft().result()                                                   #oldest first, so pages come out in $skip order
+            if page is not None:
+                window = min(workers * 2, window * 2)
+            for next_skip in islice(skips, window - len(in_flight)):
+                in_flight.append(pool.submit(contextvars.copy_context().run, fetch, *next_skip))
+
+            if page is not None:
+                print(
+                    f"\r           Returning record # {skip_param + 1} to {skip_param + top if end[0] is None else min(skip_param + top, end[0])} of {'?' if end[0] is None else end[0]}",
+                    end="",
+                    flush=True
+                )
+                yield page
+
+    evict_cache()
+
+def shard_folder():
+    """
+    Where the tasks of this execution leave their shards for the reducer, per country.
+    """
+    return os.path.join(shard_store or os.path.join(tenant().data_store, "shards"), tenant().country, task_execution)
+
+def shard_range(total_number):
+    """
+    This task's slice of an endpoint's $skip ranges: an even, contiguous share of the records.
+
+    Without a total to split, the first task fetches everything and the others nothing.
+
+    Returns:
+        tuple: (start, stop) for fetch_pages, stop None for the end of the data.
+    """
+    if total_number is None:
+        return (0, None) if task_index == 0 else (0, 0)
+    return total_number * task_index // task_count, total_number * (task_index + 1) // task_count
+
+def write_shard(endpoint, records, total_number, start, stop):
+    """
+    Pass records through while writing them to this task's shard of the endpoint.
+
+    The records go to task-<index>.jsonl, then a manifest next to it, so a manifest only exists
+    once its shard is complete.
+    """
+    folder = os.path.join(shard_folder(), endpoint)
+    os.makedirs(folder, exist_ok=True)
+    shard_path = os.path.join(folder, f"task-{task_index}")
+
+    count = 0
+    with open(f"{shard_path}.jsonl.tmp", "w") as outfile:
+        for record in records:
+            outfile.write(json.dumps(record) + "\n")
+            count += 1
+            yield record
+    os.replace(f"{shard_path}.jsonl.tmp", f"{shard_path}.jsonl")
+
+    with open(f"{shard_path}.json.tmp", "w") as outfile:
+        json.dump({"task_index": task_index, "task_count": task_count, "total_number": total_number, "range": [start, stop], "records": count}, outfile)
+    os.replace(f"{shard_path}.json.tmp", f"{shard_path}.json")
+
+def shard_manifests(endpoint):
+    """
+    The manifests of an endpoint's finished shards, in task order.
+
+    Raises:
+        Exception: The tasks were told different task counts, or saw different totals, so their
+            slices may overlap or leave gaps.
+    """
+    folder = os.path.join(shard_folder(), endpoint)
+    manifests = []
+    for entry in os.scandir(folder):
+        if entry.name.endswith(".json"):
+            with open(entry.path, "r") as file:
+                manifests.append(json.load(file))
+    manifests.sort(key=lambda manifest: manifest["task_index"])
+
+    if len({manifest["task_count"] for manifest in manifests}) > 1:
+        raise Exception(f"❌ The shards of {endpoint} in {folder} come from runs with different task counts")
+    totals = {manifest["total_number"] for manifest in manifests}
+    if len(totals) > 1:
+        raise Exception(f"❌ The tasks saw different totals for {endpoint} ({', '.join(map(str, sorted(totals, key=str)))}), ADP changed mid-extraction, rerun the job")
+    return manifests
+
+def shards_complete():
+    """
+    Whether every task has finished every endpoint it extracted.
+    """
+    folder = shard_folder()
+    if not os.path.isdir(folder):
+        return False
+    for entry in os.scandir(folder):
+        if entry.is_dir():
+            manifests = shard_manifests(entry.name)
+            if not manifests or len(manifests) < manifests[0]["task_count"]:
+                return False
+    return True
+
+def claim_reduce():
+    """
+    Decide whether this task, its extraction done, is the one to reduce.
+
+    Every task asks once its shards are written, so the last to finish sees them all complete. The
+    claim is an exclusive create, so when two finish together only one of them reduces. It names
+    the task, so when Cloud Run retries a task that died while reducing, the retry takes it over.
+    """
+    if not shards_complete():
+        return False
+    claim_path = os.path.join(shard_folder(), "reduce.claim")
+    claim = {"task_index": task_index, "attempt": int(os.getenv("CLOUD_RUN_TASK_ATTEMPT", "0"))}
+    try:
+        descriptor = os.open(claim_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+    except FileExistsError:
+        try:
+            with open(claim_path, "r") as file:
+                claimed = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return False                                                                                            #released, or still being written, by another task
+        if claimed.get("task_index") != task_index:
+            return False
+        print(f"           Taking over the reduce from attempt {claimed.get('attempt')} of task {task_index}")
+        descriptor = os.open(claim_path, os.O_WRONLY | os.O_TRUNC)
+    with os.fdopen(descriptor, "w") as outfile:
+        json.dump(claim, outfile)
+    return True
+
+def release_reduce():
+    """
+    Give up this task's claim after a failed reduce, so a rerun of any task can claim it again.
+    """
+    try:
+        os.remove(os.path.join(shard_folder(), "reduce.claim"))
+    except FileNotFoundError:
+        pass
+
+def read_shards(endpoint):
+    """
+    Stream an endpoint's records back from every task's shard, in task order, so in $skip order.
+    """
+    if not shards_complete():
+        raise Exception(f"❌ Not every task has finished extracting into {shard_folder()}")
+    folder = os.path.join(shard_folder(), endpoint)
+    for manifest in shard_manifests(endpoint):
+        with open(os.path.join(folder, f"task-{manifest['task_index']}.jsonl"), "rb") as file:
+            for line in file:
+                yield json_loads(line)
+
+def clear_shards():
+    """
+    Delete this execution's shards once the reducer has loaded them.
+    """
+    shutil.rmtree(shard_folder(), ignore_errors=True)
+
+def extract_shard(api_url, page_size, records_key):
+    """
+    Fetch this task's slice of an endpoint into its shard, for the reducer to transform and load.
+    """
+    deque(tenant().metrics.counted(sync_adp(api_url, page_size, records_key, extract=True)), maxlen=0)
+
+sync_state_lock = threading.Lock()
+
+def read_sync_state(state_path):
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path, "r") as file:
+        return json.load(file)
+
+def snapshot_projection(endpoint, select):
+    """
+    A short hash of the record_fields spec an endpoint's records are cut down to (by decode_page or
+    ADP's $select), or of True when they come whole. Saved with the high-water mark.
+    """
+    fields = record_fields[endpoint] if endpoint in record_fields and not Data_export and (field_projection or select) else True
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+whole_records = snapshot_projection(None, None)
+
+def sync_adp(api_url, page_size, records_key, extract=False):
+    """
+    Stream every record of an ADP endpoint, pulling only what changed since the last run when possible.
+
+    Endpoints with a delta_sync entry keep a snapshot of the last extraction (one JSON record per line)
+    and a high-water mark in data_store. If both exist, only records matching the delta $filter are
+    fetched; the snapshot is then streamed back with those records swapped in by key. A full pull
+    happens when full_refresh is set, the snapshot is missing, ADP rejects the filter, or the
+    snapshot's records were cut down to a different record_fields spec than the run's (unchanged
+    records would otherwise never gain a newly added field).
+
+    With server_select on, pages are asked for with a $select of the endpoint's record_fields. If
+    ADP refuses the first page with it, the endpoint is fetched without it for the rest of the run.
+
+    The new snapshot and high-water mark are only saved once the records have been fully consumed.
+
+    In a sharded run each task pulls its slice in full (a delta needs the whole snapshot) into a
+    shard instead of the snapshot. The reducer then reads the shards back in place of ADP, and
+    saves the snapshot and high-water mark from them.
+
+    Args:
+        api_url (str): The ADP endpoint.
+        page_size (int): The $top used for each page.
+        records_key (str): The list in each page holding the records, e.g. "workers".
+        extract (bool): Fetch only this task's slice, into its shard.
+
+    Yields:
+        dict: The raw records.
+    """
+    endpoint = api_url.rstrip("/").rsplit("/", 1)[-1]
+    config = delta_sync.get(endpoint)
+    snapshot_path = os.path.join(tenant().data_store, f"snapshot - {endpoint}.jsonl")
+    state_path = os.path.join(tenant().data_store, "sync_state.json")
+    run_date = datetime.now().strftime("%Y-%m-%d")
+
+    select = None
+    if server_select and endpoint in record_fields and not Data_export:
+        select = ",".join(select_paths(record_fields[endpoint], records_key))
+
+    synced = read_sync_state(state_path).get(endpoint, {})
+    high_water_mark = synced.get("high_water_mark")
+    reducing = tenant().reducing and not extract
+    delta = bool(config and high_water_mark and not full_refresh and not extract and not reducing and os.path.exists(snapshot_path))
+    if delta and synced.get("projection") not in (snapshot_projection(endpoint, select), whole_records):                #whole records still hold every field
+        print(f"           {endpoint} snapshot was saved with different record_fields, pulling every record")
+        delta = False
+
+    def open_pages(api_params):
+        # The first page and the parameters every later page is sent with, $select included when ADP takes it
+        nonlocal select
+        if not select:
+            return first_adp_page(api_url, page_size, api_params), api_params
+
+        selected_params = {**(api_params or {}), "$select": select}
+        opened = first_adp_page(api_url, page_size, selected_params)
+        if opened is not None:
+            tenant().metrics.selection(endpoint, True)
+            return opened, selected_params
+
+        opened = first_adp_page(api_url, page_size, api_params)
+        if opened is None and api_params:
+            return None, api_params                                                                                 #the filter was refused, $select gets another go with the full pull
+        print(f"           {endpoint} rejected $select, asking for whole records")
+        tenant().metrics.selection(endpoint, False)
+        select = None
+        return opened, api_params
+
+    if reducing:
+        records = read_shards(endpoint)
+    else:
+        api_params = None
+        opened = None
+        if delta:
+            since = (datetime.strptime(high_water_mark, "%Y-%m-%d") - timedelta(days=delta_overlap_days)).strftime("%Y-%m-%d")
+            opened, api_params = open_pages({"$filter": config["filter"].format(since=since)})
+            if opened is None:
+                print(f"           {endpoint} rejected the delta filter, falling back to a full refresh")
+                delta = False
+                api_params = None
+
+        if not delta:
+            opened, api_params = open_pages(None)
+            if opened is None:
+                raise Exception(f"❌ Failed to retrieve the first page of {endpoint} from API")
+
+        total_number, first_page = opened
+        start, stop = shard_range(total_number) if extract else (0, None)
+        adp_responses = fetch_pages(api_url, page_size, total_number, api_params, first_page if start == 0 else None, start, stop)                         # Pages come back in $skip order, so the output matches the serial walk
+        records = (record for item in adp_responses for record in item[records_key])
+
+    if extract:
+        yield from write_shard(endpoint, records, total_number, start, stop)
+        return
+
+    if config is None:
+        yield from records
+        return
+
+    def record_key(record):
+        return record.get(config["key"]) or json.dumps(record, sort_keys=True)
+
+    os.makedirs(tenant().data_store, exist_ok=True)
+    with open(f"{snapshot_path}.tmp", "w") as outfile:
+        if delta:
+            changes = {record_key(record): record for record in records}
+            changed = len(changes)
+            with open(snapshot_path, "r") as file:
+                for line in file:
+                    record = json_loads(line)
+                    record = changes.pop(record_key(record), record)                                            #changed records keep their place, new ones go on the end
+                    outfile.write(json.dumps(record) + "\n")
+                    yield record
+            added = len(changes)
+            for record in changes.values():
+                outfile.write(json.dumps(record) + "\n")
+                yield record
+            print()
+            print(f"           {endpoint}: {changed} changed since {high_water_mark} ({added} new)")
         else:
-            print(f"Failed to retrieve data from API for skip_param {skip_param}. Status code: {api_response.status_code}")
+            for record in records:
+                outfile.write(json.dumps(record) + "\n")
+                yield record
+
+    os.replace(f"{snapshot_path}.tmp", snapshot_path)
+    with sync_state_lock:                                                                                           #endpoints sync side by side, each only changes its own entry
+        state = read_sync_state(state_path)
+        state[endpoint] = {"high_water_mark": run_date, "projection": snapshot_projection(endpoint, select)}
+        with open(f"{state_path}.tmp", "w") as outfile:
+            json.dump(state, outfile, indent=4)
+        os.replace(f"{state_path}.tmp", state_path)
+
+def snapshot_path(name, format=None):
+    return os.path.join(tenant().data_store, name + (".arrow" if (format or export_format) == "arrow" else ".json"))
+
+@lru_cache(maxsize=None)
+def json_schema():
+    return pa.schema([("json", pa.large_string())], metadata={"encoding": "json"})
+
+def json_batch(records):
+    """
+    Pack records into a single-column record batch of JSON strings.
 
-    total_records = 0
-    skip_param = 0
+    Raw ADP payloads are deeply nested and their shape drifts from record to record, so they are
+    kept verbatim rather than forced into one Arrow schema (which would turn missing keys into nulls
+    and widen ints next to floats).
+    """
+    return pa.record_batch([pa.array([json.dumps(record) for record in records], pa.large_string())], schema=json_schema())
 
-    while True:
-        print(
-            f"\r           Returning record # {total_records + 1} to {total_records + 100} of {rounded_total_number}",
-            end="",
-            flush=True
-        )
-        make_api_request_active(skip_param)
-        skip_param += 100
-        total_records += 100 
+def snapshot_writer(name, schema):
+    return pa.ipc.new_file(snapshot_path(name), schema, options=pa.ipc.IpcWriteOptions(compression=snapshot_compression))
 
-        if total_records >= rounded_total_number:  
-            break
+def export_records(records, file_name):
+    """
+    Pass records through unchanged while writing them to data_store as a snapshot.
+
+    As JSON the file is identical to json.dump(records, outfile, indent=4), as Arrow it holds one
+    batch of JSON strings per snapshot_batch_rows records. Either way the records never have to be
+    gathered into one list.
+    """
+    if export_format == "arrow":
+        with snapshot_writer(file_name, json_schema()) as writer:
+            batch = []
+            for record in records:
+                batch.append(record)
+                if len(batch) == snapshot_batch_rows:
+                    writer.write_batch(json_batch(batch))
+                    batch = []
+                yield record
+            if batch:
+                writer.write_batch(json_batch(batch))
+        return
+
+    with open(snapshot_path(file_name), "w") as outfile:
+        written = 0
+        for record in records:
+            outfile.write(",\n" if written else "[\n")
+            outfile.write(textwrap.indent(json.dumps(record, indent=4), "    "))
+            written += 1
+            yield record
+        outfile.write("\n]" if written else "[]")
+
+def export_snapshot(records, file_name, raw=False):
+    """
+    Write a list of records to data_store as a snapshot.
+
+    Flat stage outputs become real columns. Raw payloads (raw=True), or records whose values
+    Arrow cannot fit into one type per column, are stored as JSON strings instead.
+    """
+    if export_format != "arrow":
+        with open(snapshot_path(file_name), "w") as outfile:
+            json.dump(records, outfile, indent=4)
+        return
+
+    table = None
+    if not raw:
+        try:
+            table = pa.Table.from_pylist(records)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            pass
+    if table is None:
+        table = pa.Table.from_batches([json_batch(records)])
+
+    with snapshot_writer(file_name, table.schema) as writer:
+        writer.write_table(table, max_chunksize=snapshot_batch_rows)
 
-    combined_staff = []
-    for item in adp_responses:
-        combined_staff.extend(item["workers"])
+def replay_snapshot(file_name):
+    """
+    Read records back from a snapshot written by export_records or export_snapshot.
+
+    Arrow snapshots are memory-mapped and decoded one record batch at a time as the records are
+    consumed, so replay starts straight away however large the file is. Uncompressed, their
+    buffers are read in place. Whichever format export_format names is read when it exists,
+    otherwise the other one, so older JSON drops still replay.
+
+    Yields:
+        dict: The records, in the order they were written.
+    """
+    format = export_format if os.path.exists(snapshot_path(file_name)) else ("json" if export_format == "arrow" else "arrow")
+
+    if format != "arrow":
+        with open(snapshot_path(file_name, format), "r") as file:
+            yield from json.load(file)
+        return
+
+    with pa.memory_map(snapshot_path(file_name, format)) as source:
+        reader = pa.ipc.open_file(source)
+        encoding = (reader.schema.metadata or {}).get(b"encoding")
+        for index in range(reader.num_record_batches):
+            batch = reader.get_batch(index)
+            if encoding == b"json":
+                yield from map(json_loads, batch.column(0).to_pylist())
+            else:
+                yield from batch.to_pylist()
+
+def GET_staff_adp():
+    time_now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print()
+    print ("Retrieving Current Staff from ADP Workforce Now (" + time_now + ")")
+    api_url = f'{adp_base_url}/hr/v2/workers'
+
+    combined_staff = tenant().metrics.counted(sync_adp(api_url, 100, "workers"))
     
     if Data_export:     
-        file_path = os.path.join(data_store,"001a - Raw Staff.json")
-        with open(file_path, "w") as outfile:
-            json.dump(combined_staff, outfile, indent=4)
+        combined_staff = export_records(combined_staff, "001a - Raw Staff")
 
-    reordered_staff = []
     dead_letters = []
+    filtered_staff = [record for record in transform_staff(combined_staff, dead_letters) if record.status in ["Active", "Inactive"]]
+    tenant().metrics.records(records_out=len(filtered_staff), dead_letters=len(dead_letters))
+    
+    if Data_export:     
+        export_snapshot([record.as_dict() for record in filtered_staff], "001b - Reordered + Filtered Staff")
+        export_snapshot(dead_letters, "001a - Dead letters", raw=True)
+    
+    return filtered_staff
+
+def transform_staff(combined_staff, dead_letters):
+    """
+    Reorder raw ADP workers one at a time as they stream in.
+
+    Workers missing a required field are appended to dead_letters instead.
+
+    Yields:
+        Staff: The staff record, dates parsed.
+    """
     for staff in combined_staff:
         try:
             forename = staff["person"]["legalName"]["givenName"]
             middleName = staff["person"]["legalName"].get("middleName")
-            givenName = staff["person"]["legalName"].get("givenName")
             preferredName = (
                 None
                 if not staff["person"].get("preferredName") 
@@ -237,284 +1576,295 @@ def GET_staff_adp():
                 (index for index, field in enumerate(staff["workAssignments"]) if field["primaryIndicator"] is True),
             )
 
-            manager = staff["workAssignments"][position].get("reportsTo", None)
-            formatted_name = None
-            if manager:
-                formatted_name = manager[0]["reportsToWorkerName"].get("formattedName", "") 
             manager = staff["workAssignments"][position].get("reportsTo", None)
             formatted_name = None
             if manager:
                 formatted_name = manager[0]["reportsToWorkerName"].get("formattedName", "") 
 
-            transformed_staff = {
-                "Forename": forename,
-                "MiddleName": middleName,
-                "givenName": givenName,
-                "prefferedName": preferredName,
-                "Surname": surname,
-                "Status": status,
-                "BirthDate": dob,
-                "Address": address,
-                "Hire Date": hireDate,
-                "Manager": formatted_name
-            }
-            
-            reordered_staff.append(transformed_staff)
+            transformed_staff = Staff(forename, middleName, preferredName, surname, status, dob, address, hireDate, formatted_name)
             
         except Exception as e:
             dead_letters.append({
                 "staff": staff,
                 "error": str(e)
             })
-    
-    filtered_staff = [record for record in reordered_staff if record["Status"] in ["Active", "Inactive"]]
-    
-    if Data_export:     
-        file_path = os.path.join(data_store,"001b - Reordered + Filtered Staff.json")
-        with open(file_path, "w") as outfile:
-            json.dump(filtered_staff, outfile, indent=4)
-        file_path = os.path.join(data_store,"001a - Dead letters.json")
-        with open(file_path, "w") as outfile:
-            json.dump(dead_letters, outfile, indent=4)
-    
-    return filtered_staff
+            continue
 
-def GET_applicants_adp(staff):
-    if testing is False:
-        current_date = datetime.now()                                      
-        months = current_date - timedelta(days=500)
-        formatted_date = months.strftime("%Y-%m-%d")
+        yield transformed_staff
 
+def GET_applicants_adp():
+    if testing is False:
         time_now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         print ()
         print ("Retrieving Applicants from ADP Workforce Now (" + time_now + ")")
-        api_url = 'https://api.adp.com/staffing/v2/job-applications'
-        api_headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Accept':"application/json;masked=false",  
-            }
-        api_count_params = {
-                "count": "true",
-            }
-
-        api_count_response = requests.get(api_url, cert=(temp_certfile, temp_keyfile), verify=True, headers=api_headers, params=api_count_params)                 #data request. Find number of records and uses this to find the pages needed
-        response_data = api_count_response.json()
-        total_number = response_data.get("meta", {}).get("totalNumber", 0)
-        rounded_total_number = math.ceil(total_number / 100) * 100
-
-        adp_responses = []                                                                                                                              # Initialize an empty list to store API responses. This will also store the outputted data
+        api_url = f'{adp_base_url}/staffing/v2/job-applications'
 
-        def make_api_request_active(skip_param):                                                                                                        # Function to make an API request with skip_param and append the response to all_responses
+        combined_applications = tenant().metrics.counted(sync_adp(api_url, 20, "jobApplications"))
+        
+        if Data_export:     
+            combined_applications = export_records(combined_applications, "002a - Raw Applications")
 
-            api_headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Accept':"application/json;masked=false"
-                }
-    
-            api_params = {
-                #"$filter": "applicationSource/submittedDate ge 2023-06-01",
-                "$top": 20,
-                "$skip": skip_param,
-                }
+    if testing:
+        print ("Loading data from saved applications")
+        combined_applications = tenant().metrics.counted(replay_snapshot("002a - Raw Applications"))
 
-            api_response = requests.get(api_url, cert=(temp_certfile, temp_keyfile), verify=True, headers=api_headers, params=api_params)
-            #time.sleep(0.6)
+    dead_letters_app = []
+    reordered_applications = list(transform_applications(combined_applications, dead_letters_app))
+    tenant().metrics.records(records_out=len(reordered_applications), dead_letters=len(dead_letters_app))
 
-            if api_response.status_code == 200:
-                #checks the response and writes the response to a variable
-                json_data = api_response.json()
+    if Data_export:     
+        export_snapshot(dead_letters_app, "002c - Dead letters applications", raw=True)
 
-                # Append the response to all_responses
-                adp_responses.append(json_data)
+    return reordered_applications
 
-                # Check for a 204 status code and break the loop
-                if api_response.status_code == 204:
-                    return True
-            elif api_response.status_code == 204:
-                return True
-            else:
-                print(f"Failed to retrieve data from API for skip_param {skip_param}. Status code: {api_response.status_code}")
+@lru_cache(maxsize=None)
+def line_manager_name(hiring_manager):
+    """
+    Reorder an ADP "Surname, Forename" hiring manager into "Forename Surname".
 
-        total_records = 0
-        skip_param = 0
+    Only a few dozen distinct managers appear across all applications, so each is worked out once.
+    """
+    names = hiring_manager.split(", ")
+    if len(names) == 2:
+        secondName,firstName = names
+        lineManager = f"{firstName} {secondName}"
+    else:
+        lineManager = ""
 
-        while True:
-            print(
-                f"\r           Returning record # {total_records + 1} to {total_records + 20} of {rounded_total_number}",
-                end="",
-                flush=True
-            )
+    if lineManager == "Zacri Byam":
+        lineManager = "Zac Byam"
 
-            
-            make_api_request_active(skip_param)
-            skip_param += 20
-            total_records += 20 
+    return lineManager
 
-            if total_records >= rounded_total_number:  
-                break
+@lru_cache(maxsize=None)
+def recruiter_alias(recruiter):
+    """
+    Map the recruiter names ADP holds onto the names the dashboard reports, worked out once per distinct name.
+    """
+    if "Guerrero" in recruiter:
+        recruiter = "Robinson Guerrero"
+    elif "Dana" in recruiter:
+        recruiter = "Dana Schwartz"
+    elif "Schwartz" in recruiter:
+        recruiter = "Dana Schwartz"
+    elif "Julia" in recruiter:
+        recruiter = "Julia Peoples"
+    elif "Robyn" in recruiter:
+        recruiter = "Robyn Halliday"
+
+    return recruiter
+
+def transform_applications(combined_applications, dead_letters_app):
+    """
+    Reorder raw ADP job applications one at a time as they stream in.
 
-        combined_applications = []
-        for item in adp_responses:
-            combined_applications.extend(item["jobApplications"])
-        
-        if Data_export:     
-            file_path = os.path.join(data_store,"002a - Raw Applications.json")
-            with open(file_path, "w") as outfile:
-                json.dump(combined_applications, outfile, indent=4)
+    Each nested block is looked up once per application, in the same order as before, so a
+    broken application fails with the same error. Hiring manager and recruiter names go through
+    the cached line_manager_name/recruiter_alias mappings.
 
-    if testing:
-        print ("Loading data from saved applications")
-        file_path = os.path.join(data_store,"002a - Raw Applications.json")
-        with open(file_path, "r") as file:
-            combined_applications = json.load(file)
+    Applications missing a required field are appended to dead_letters_app instead.
 
-    reordered_applications = []
-    dead_letters_app = []
+    Yields:
+        Application: The application, dates parsed and match_made still unset.
+    """
     for apps in combined_applications:
         try:
-            name = apps["applicant"]["person"]["personName"].get("formattedName","")
-            forename = apps["applicant"]["person"]["personName"].get("givenName","")
-            surname = apps["applicant"]["person"]["personName"].get("familyName1","")
+            person_name = apps["applicant"]["person"]["personName"]
+            name = person_name.get("formattedName","")
+            forename = person_name.get("givenName","")
+            surname = person_name.get("familyName1","")
 
-            app_start = apps["applicationStatusCode"].get("effectiveDate","")
+            status_code = apps["applicationStatusCode"]
+            app_start = status_code.get("effectiveDate","")
             app_dob = apps["applicant"]["person"].get("birthDate","")
-            app_status = apps["applicationStatusCode"].get("shortName","")
-            app_job = apps["jobRequisitionReference"].get("requisitionTitle","")
+            app_status = status_code.get("shortName","")
+            requisition = apps["jobRequisitionReference"]
+            app_job = requisition.get("requisitionTitle","")
             
-            hiring_manager = str(apps["jobRequisitionReference"].get("hiringManager", {}).get("personName", {}).get("formattedName",""))
-            if hiring_manager:
-                names = hiring_manager.split(", ")
-                if len(names) == 2:
-                    secondName,firstName = names
-                    lineManager = f"{firstName} {secondName}"
-                else:
-                    lineManager = ""
-
-            if lineManager == "Zacri Byam":
-                lineManager = "Zac Byam"
+            hiring_manager = str(requisition.get("hiringManager", {}).get("personName", {}).get("formattedName",""))
+            lineManager = line_manager_name(hiring_manager) if hiring_manager else ""
             
-            recruiter = str(apps["jobRequisitionReference"].get("recruiter", {}).get("personName", {}).get("formattedName",""))
-            requisition_id = apps["jobRequisitionReference"].get("requisitionID","")
+            recruiter = recruiter_alias(str(requisition.get("recruiter", {}).get("personName", {}).get("formattedName","")))
+            requisition_id = requisition.get("requisitionID","")
             address = apps["applicant"]["person"]["address"].get("lineOne","")
-
-            if "Guerrero" in recruiter:
-                recruiter = "Robinson Guerrero"
-            elif "Dana" in recruiter:
-                recruiter = "Dana Schwartz"
-            elif "Schwartz" in recruiter:
-                recruiter = "Dana Schwartz"
-            elif "Julia" in recruiter:
-                recruiter = "Julia Peoples"
-            elif "Robyn" in recruiter:
-                recruiter = "Robyn Halliday"
             
-            transformed_record = {
-                "CandidateName": name,
-                "forename": forename,
-                "surname": surname,
-                "DOB": app_dob,
-                "ApplicationStatus": app_status,
-                "JobTitle": app_job,
-                "HiringManager": hiring_manager,
-                "LineManager": lineManager,
-                "Recruiter": recruiter,
-                "Requisition_ID": requisition_id,
-                "Start Date": app_start,
-                "Address": address,
-                "Match Made": None,
-            }
+            transformed_record = Application(name, forename, surname, app_dob, app_status, app_job, hiring_manager,
+                                             lineManager, recruiter, requisition_id, app_start, address)
             
-            reordered_applications.append(transformed_record)
         except Exception as e:
             dead_letters_app.append({
                 "staff": apps,
                 "error": str(e)
             })
+            continue
+
+        yield transformed_record
+
+def build_staff_index(staff, rules=None):
+    """
+    Index the staff list once so each application only has to be compared with likely matches.
+
+    Under "legacy" match_rules the keys mirror what the old nested staff loop compared: the
+    lower-cased forename and surname, the birth date and the hire date. That loop read a
+    "middleName" key staff records never had, so an empty application forename agreed with
+    everyone, and it compared givenName and preferredName as unbound `.lower` methods, which never
+    matched, so they are not indexed.
+
+    Under "strict" a record is also indexed under its middle and preferred names and its manager,
+    reordered by line_manager_name into the "Forename Surname" form applications carry, and empty
+    values are left out so two missing values never agree.
+
+    Args:
+        staff (list): Staff records.
+        rules (str): "legacy" or "strict", match_rules when not given.
+
+    Returns:
+        dict: Hash indexes of staff positions, plus hire days sorted for the ±5-day window.
+    """
+    rules = rules or match_rules
+    if rules not in ("legacy", "strict"):
+        raise Exception(f"❌ Unknown match_rules {rules}, expected legacy or strict")
+    index = {
+        "rules": rules,
+        "count": len(staff),
+        "forename": defaultdict(set),
+        "surname": defaultdict(set),
+        "manager": defaultdict(set),
+        "dob": defaultdict(set),
+        "eligible": [],
+    }
+    hire_dates = []
+
+    for position, record in enumerate(staff):
+        if rules == "legacy":
+            index["forename"][(record.forename or "").lower()].add(position)
+            index["forename"][""].add(position)
+            index["surname"][(record.surname or "").lower()].add(position)
+            index["dob"][record.birth_date].add(position)
+        else:
+            for name in (record.forename, record.middle_name, record.preferred_name):
+                if name:
+                    index["forename"][name.lower()].add(position)
+            if record.surname:
+                index["surname"][record.surname.lower()].add(position)
+            manager = line_manager_name(record.manager) if record.manager else ""
+            if manager:
+                index["manager"][manager].add(position)
+            if record.birth_date:
+                index["dob"][record.birth_date].add(position)
+
+        staff_status = (record.status or "").lower()
+        index["eligible"].append("active" in staff_status or "inactive" in staff_status)
+
+        if record.hire_date:
+            hire_dates.append((record.hire_date.toordinal(), position))
+
+    hire_dates.sort()
+    index["hire_days"] = [day for day, _ in hire_dates]
+    index["hire_positions"] = [position for _, position in hire_dates]
+
+    return index
+
+def find_staff_match(app, index):
+    """
+    Check whether an application matches an eligible staff record on 3 or more of: forename,
+    surname, manager, start date within 5 days of hire date, and date of birth.
+
+    Under "legacy" match_rules the manager criterion holds for every staff record: the old loop
+    compared an application "Manager" key with a staff "LineManager" key, neither of which the
+    records carried.
+
+    Args:
+        app (Application): A transformed application.
+        index (dict): The output of build_staff_index.
+
+    Returns:
+        bool: True if a match was found.
+    """
+    criteria = [
+        index["forename"].get((app.forename or "").lower(), ()),
+        index["surname"].get((app.surname or "").lower(), ()),
+        index["dob"].get(app.dob, ()),
+    ]
+    if index["rules"] == "strict":
+        criteria.append(index["manager"].get(app.line_manager, ()) if app.line_manager else ())
+
+    if app.start_date:
+        start_day = app.start_date.toordinal()
+        low = bisect_left(index["hire_days"], start_day - 5)
+        high = bisect_right(index["hire_days"], start_day + 5)
+        criteria.append(set(index["hire_positions"][low:high]))
+
+    # A criterion every staff record meets (the legacy manager, or e.g. an empty forename) is counted once up front rather than per record
+    everyone = (index["rules"] == "legacy") + sum(1 for positions in criteria if len(positions) == index["count"])
+    needed = 3 - everyone
+    if needed <= 0:
+        return any(index["eligible"])
+
+    # A record in `needed` of these m criteria is missing from at most m - needed of them, so it is in
+    # at least one of the m - needed + 1 smallest: only those are walked, the rest are just looked up
+    others = sorted((positions for positions in criteria if len(positions) != index["count"]), key=len)
+    if len(others) < needed:
+        return False
+    candidates = set().union(*others[:len(others) - needed + 1])
+
+    return any(
+        index["eligible"][position] and sum(position in positions for positions in others) >= needed
+        for position in candidates
+    )
+
+def match_applicants(reordered_applications, staff):
+    time_now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print ()
+    print ("Matching Applicants to Current Staff (" + time_now + ")")
+
+    staff_index = build_staff_index(staff)
 
     for app in reordered_applications:                          #Tries to find a matching staff member in the ADP record
-        app_forename = app.get("forename", "").lower()
-        app_surname = app.get("surname","").lower()
-        app_start_date = app.get("Start Date")
-        app_manager = app.get("Manager")
-        app_dob = app.get("DOB","")
-
-        # Flag to check if a matching record is found
-        match_found = False
-        
-        for record in staff:
-            staff_forename = record.get("Forename", "").lower()
-            staff_middlename = record.get("middleName","").lower()
-            staff_given_name = record.get("givenName","").lower
-            staff_preferred_name = record.get("preferredName","").lower
-            staff_surname = record.get("Surname", "").lower()
-            staff_status = record.get("Status", "").lower()
-            staff_hire_date = record.get("Hire Date")
-            staff_lineManager = record.get("LineManager")
-            staff_dob = record.get("BirthDate")
-
-            # Match criteria
-            matches = 0
-            if app_forename in {staff_forename, staff_middlename, staff_given_name,staff_preferred_name}:
-                matches += 1
-            if app_surname == staff_surname:
-                matches += 1
-            if app_manager == staff_lineManager:
-                matches += 1
-            
-            if app_start_date and staff_hire_date:
-                start_date = datetime.strptime(app_start_date, "%Y-%m-%d")
-                hire_date = datetime.strptime(staff_hire_date, "%Y-%m-%d")
-                if abs((start_date - hire_date).days) <= 5:
-                    matches += 1
-            
-            if app_dob == staff_dob:
-                matches +=1
+        if find_staff_match(app, staff_index):
+            app.match_made = True
 
-            # Check if two or more criteria match
-            if matches >= 3 and ("active" in staff_status or "inactive" in staff_status):
-                match_found = True
-                break
-        
-        # Set the 'Active?' field based on match
-        if match_found:
-            app["Match Made"] = True
+    if Data_export:     
+        export_snapshot([app.as_dict() for app in reordered_applications], "002b - New Applications")
+
+    filtered_applications = dedupe_applications(reordered_applications)
+    tenant().metrics.records(records_in=len(reordered_applications), records_out=len(filtered_applications))
 
     if Data_export:     
-        file_path = os.path.join(data_store,"002b - New Applications.json")
-        with open(file_path, "w") as outfile:
-            json.dump(reordered_applications, outfile, indent=4)
-        file_path = os.path.join(data_store,"002c - Dead letters applications.json")
-        with open(file_path, "w") as outfile:
-            json.dump(dead_letters_app, outfile, indent=4)
+        export_snapshot([app.as_dict() for app in filtered_applications], "002c - Filtered Applications")
+
+    return filtered_applications
 
+def dedupe_applications(reordered_applications):
+    """
+    Keep the applications at an Offer, Screening or Hire status (and not Deleted or Declined),
+    one per candidate: their Hired application if they have one, otherwise the first by status.
+
+    Returns:
+        list: The filtered applications.
+    """
     keywords_to_include = ["Offer","Screening","Hire"]
     keywords_to_exclude = ["Deleted","Declined"]
 
     filtered_applications = [
         application for application in reordered_applications
-        if any(keyword in application["ApplicationStatus"] for keyword in keywords_to_include)
-        and not any(keyword in application["ApplicationStatus"] for keyword in keywords_to_exclude)
+        if any(keyword in application.status for keyword in keywords_to_include)
+        and not any(keyword in application.status for keyword in keywords_to_exclude)
     ]
 
-    sorted_applications = sorted(filtered_applications, key=lambda x: (x["CandidateName"], x["ApplicationStatus"]))
+    sorted_applications = sorted(filtered_applications, key=lambda x: (x.candidate_name, x.status))
 
     filtered_applications = {}
     for application in sorted_applications:
-        candidate_name = application["CandidateName"]
+        candidate_name = application.candidate_name
         if (
             candidate_name not in filtered_applications or
-            application["ApplicationStatus"] == "Hired"
+            application.status == "Hired"
         ):
             filtered_applications[candidate_name] = application
     
     filtered_applications = list(filtered_applications.values())
 
-
-    if Data_export:     
-        file_path = os.path.join(data_store,"002c - Filtered Applications.json")
-        with open(file_path, "w") as outfile:
-            json.dump(filtered_applications, outfile, indent=4)
-
     return filtered_applications
 
 def GET_reqs():
@@ -522,80 +1872,29 @@ def GET_reqs():
     time_now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     print ()
     print ("Retrieving Requisitions from ADP Workforce Now (" + time_now + ")")
-    api_url = 'https://api.adp.com/staffing/v1/job-requisitions'
-    api_headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Accept':"application/json;masked=false",  
-        }
-
-    api_count_params = {
-            "count": "true",
-        }
-
-    api_count_response = requests.get(api_url, cert=(temp_certfile, temp_keyfile), verify=True, headers=api_headers, params=api_count_params)                 #data request. Find number of records and uses this to find the pages needed
-    response_data = api_count_response.json()
-    total_number = response_data.get("meta", {}).get("totalNumber", 0)
-    rounded_total_number = math.ceil(total_number / 100) * 100
+    api_url = f'{adp_base_url}/staffing/v1/job-requisitions'
 
-    adp_responses = []                                                                                                                              # Initialize an empty list to store API responses. This will also store the outputted data
+    combined_requisitions = tenant().metrics.counted(sync_adp(api_url, 20, "jobRequisitions"))
 
-    def make_api_request_active(skip_param):                                                                                                        # Function to make an API request with skip_param and append the response to all_responses
-
-        api_headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Accept':"application/json;masked=false"
-            }
-        api_params = {
-            "$top": 20,
-            "$skip": skip_param,
-            }
-
-        api_response = requests.get(api_url, cert=(temp_certfile, temp_keyfile), verify=True, headers=api_headers, params=api_params)
-        #time.sleep(0.6)
-
-        if api_response.status_code == 200:
-            #checks the response and writes the response to a variable
-            json_data = api_response.json()
-
-            # Append the response to all_responses
-            adp_responses.append(json_data)
-
-            # Check for a 204 status code and break the loop
-            if api_response.status_code == 204:
-                return True
-        elif api_response.status_code == 204:
-            return True
-        else:
-            print(f"Failed to retrieve data from API for skip_param {skip_param}. Status code: {api_response.status_code}")
-
-    total_records = 0
-    skip_param = 0
-
-    while True:
-        print(
-            f"\r           Returning record # {total_records + 1} to {total_records + 20} of {rounded_total_number}",
-            end="",
-            flush=True
-        )
+    if Data_export:     
+        combined_requisitions = export_records(combined_requisitions, "003a -Raw Requisitions")
 
-        make_api_request_active(skip_param)
-        skip_param += 20
-        total_records += 20 
+    reordered_requisitions = list(transform_requisitions(combined_requisitions))
+    tenant().metrics.records(records_out=len(reordered_requisitions))
 
-        if total_records >= rounded_total_number:  
-            break
+    if Data_export:     
+        export_snapshot([requisition.as_dict() for requisition in reordered_requisitions], "003 - Requisitions")
 
-    combined_requisitions = []
-    for item in adp_responses:
-        combined_requisitions.extend(item["jobRequisitions"])
 
-    if Data_export:     
-        file_path = os.path.join(data_store,"003a -Raw Requisitions.json")
-        with open(file_path, "w") as outfile:
-            json.dump(combined_requisitions, outfile, indent=4)
+    return reordered_requisitions
 
+def transform_requisitions(combined_requisitions):
+    """
+    Reorder raw ADP job requisitions one at a time as they stream in.
 
-    reordered_requisitions = []
+    Yields:
+        Requisition: The requisition, posting date parsed.
+    """
     for reqs in combined_requisitions:
         req_id = reqs["itemID"]
         postdate = reqs["postingInstructions"][0].get("postDate")
@@ -609,96 +1908,159 @@ def GET_reqs():
         else:
             req_type = None
 
-        transformed_record = {
-            "Requisition ID": req_id,
-            "Posted Date": postdate,
-            "req_type": req_type
-        }
+        transformed_record = Requisition(req_id, postdate, req_type)
         
-        reordered_requisitions.append(transformed_record)
+        yield transformed_record
 
-    if Data_export:     
-        file_path = os.path.join(data_store,"003 - Requisitions.json")
-        with open(file_path, "w") as outfile:
-            json.dump(reordered_requisitions, outfile, indent=4)
+def filter_adp(adp_applications,adp_reqs):
+    """
+    Join applications to their requisitions and work out DaystoHire and StillEmployed.
 
+    Dates were parsed when the records were built, so this is a single pass over the applications
+    with a dictionary lookup for each requisition, and the cost grows linearly with the number of
+    applications rather than applications x requisitions.
 
-    return reordered_requisitions
+    This replaced a column-wise pandas merge. With the records already carrying parsed dates,
+    building the frames cost more than the merge saved. The merge's edge cases are kept: no
+    requisition gives ReqType None, and a missing date gives DaystoHire 0.
 
-def filter_adp(adp_applications,adp_reqs):
+    Returns:
+        list: One dict per application, in the shape reload_bigquery loads.
+    """
     time_now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     print ("        Creating data Table (" + time_now + ")")
-    
+
+    requisitions = {}
+    for requisition in adp_reqs:
+        requisitions.setdefault(requisition.requisition_id, requisition)                                              #the old scan stopped at the first requisition with a matching ID
+
+    hired_since = datetime.now() - timedelta(days=21)                                                                  #check this with Stephanie
+
     output = []
-    
-    for apps in adp_applications:
-        name = apps["CandidateName"] 
-        status = apps["ApplicationStatus"]     
-        jobTitle = apps["JobTitle"]     
-        hiringManager = apps["HiringManager"]     
-        recruiter = apps["Recruiter"]     
-        recID = apps["Requisition_ID"]     
-        hireDate = apps["Start Date"]
-        onRoll = apps["Match Made"]     
-    
-        posted_date = None
-        for req in adp_reqs:
-            if req["Requisition ID"] == recID:
-                posted_date = req.get("Posted Date") 
-                req_type = req.get("req_type") 
-                break  
-
-        if posted_date:
-            posted_date = posted_date[:10]
-            start_date_dt = datetime.strptime(hireDate, "%Y-%m-%d")
-            posted_date_dt = datetime.strptime(posted_date, "%Y-%m-%d")
-            days_to_hire = max(0, (start_date_dt - posted_date_dt).days)
-        else:
-            days_to_hire = 0
-
-        if hireDate:
-            hire_date_parsed = datetime.strptime(hireDate, "%Y-%m-%d")  
-            if hire_date_parsed >= datetime.now() - timedelta(days=21):         #check this with Stephanie            
-                onRoll = True
-
-        transformed_record = {
-            "CandidateName": name,
-            "ApplicationStatus": status,
-            "JobTitle": jobTitle,
-            "HiringManager": hiringManager,
-            "Recruiter": recruiter,
-            "RequisitionCreateDate": posted_date,
-            "DateofHire": hireDate,
+    for app in adp_applications:
+        requisition = requisitions.get(app.requisition_id)
+        posted_date = requisition.posted_date if requisition else None
+        hire_date = app.start_date
+
+        days_to_hire = max(0, (hire_date - posted_date).days) if hire_date and posted_date else 0
+        recently_hired = bool(hire_date) and datetime(hire_date.year, hire_date.month, hire_date.day) >= hired_since
+
+        output.append({
+            "CandidateName": app.candidate_name,
+            "ApplicationStatus": app.status,
+            "JobTitle": app.job_title,
+            "HiringManager": app.hiring_manager,
+            "Recruiter": app.recruiter,
+            "RequisitionCreateDate": format_date(posted_date),
+            "DateofHire": format_date(hire_date),
             "DaystoHire": days_to_hire,
-            "StillEmployed": onRoll,
-            "ReqType": req_type,
-        }
-        
-
+            "StillEmployed": True if recently_hired else app.match_made,
+            "ReqType": requisition.req_type if requisition else None,
+        })
 
-        output.append(transformed_record)
+    tenant().metrics.records(records_in=len(adp_applications), records_out=len(output))
 
     if Data_export:
-        file_path = os.path.join(data_store, "004 - Export to looker.json")
-        with open(file_path, "w") as outfile:
-            json.dump(output, outfile, indent=4)
+        export_snapshot(output, "004 - Export to looker")
 
-        file_path = os.path.join(data_store, "005 - main schema.csv")
         df=pd.DataFrame(output)
-        df.to_csv(file_path, index=False)
+        if export_format == "arrow":
+            file_path = os.path.join(tenant().data_store, "005 - main schema.parquet")
+            df.to_parquet(file_path, index=False, compression="zstd")
+        else:
+            file_path = os.path.join(tenant().data_store, "005 - main schema.csv")
+            df.to_csv(file_path, index=False)
     
     return output
 
-def reload_bigquery():
+def prepare_staging(client):
+    """
+    Create the staging table with the main table's schema, so it is ready before filter_adp finishes.
+
+    A staging table left behind by an earlier run is dropped first rather than reused, so one
+    with an old schema can never be loaded and copied over the main table.
+
+    Args:
+        client (bigquery.Client): The BigQuery client (or a stand-in with the same calls).
+
+    Returns:
+        bigquery.Table: The staging table, or None when bigquery_load_mode is "dml".
+    """
+    if bigquery_load_mode != "staging":
+        return None
+
+    main_table = client.get_table(f"{bigquery_project}.{tenant().dataset}.{bigquery_table}")
+    staging_table = bigquery.Table(f"{bigquery_project}.{tenant().dataset}.{bigquery_table}_staging", schema=main_table.schema)
+    staging_table.expires = datetime.now(timezone.utc) + timedelta(days=1)                                         #left behind only if a run dies between load and copy
+
+    client.delete_table(staging_table, not_found_ok=True)
+    return client.create_table(staging_table)
+
+def looker_arrow(looker_data, schema):
+    """
+    Build the Arrow table loaded into BigQuery straight from the filter_adp records.
+
+    Date strings are parsed column-wise into whatever the BigQuery column holds (DATE, DATETIME or
+    TIMESTAMP); values that do not parse become null, as pd.to_datetime(errors='coerce') did.
+
+    Args:
+        looker_data (list): The filter_adp output.
+        schema (list): The BigQuery SchemaFields of the destination table.
+
+    Returns:
+        pyarrow.Table: The table, with columns in schema order.
+    """
+    arrow_types = {
+        "STRING": pa.string(),
+        "INTEGER": pa.int64(),
+        "INT64": pa.int64(),
+        "FLOAT": pa.float64(),
+        "FLOAT64": pa.float64(),
+        "BOOLEAN": pa.bool_(),
+        "BOOL": pa.bool_(),
+        "DATE": pa.date32(),
+        "DATETIME": pa.timestamp("us"),
+        "TIMESTAMP": pa.timestamp("us", tz="UTC"),
+    }
+    date_types = ("DATE", "DATETIME", "TIMESTAMP")
+
+    string_schema = pa.schema([
+        (field.name, pa.string() if field.field_type in date_types else arrow_types[field.field_type])
+        for field in schema
+    ])
+    table = pa.Table.from_pylist(looker_data, schema=string_schema)
+
+    for field in schema:
+        if field.field_type in date_types:
+            position = table.schema.get_field_index(field.name)
+            parsed = pc.strptime(pc.utf8_slice_codeunits(table[field.name], 0, 10), format="%Y-%m-%d", unit="us", error_is_null=True)
+            table = table.set_column(position, field.name, parsed.cast(arrow_types[field.field_type]))
+
+    return table
+
+def reload_bigquery(looker_data, client=None, staging_table=None):
+    """
+    Replace the dashboard table with the filter_adp output.
+
+    In "staging" mode the records go from Arrow to Parquet into the staging table, which is then
+    copied over the main table with WRITE_TRUNCATE in one atomic job, so the dashboard never sees
+    an empty table. "dml" mode is the old DELETE then load_table_from_dataframe.
+
+    Args:
+        looker_data (list): The filter_adp output.
+        client (bigquery.Client): The client to use, or a local stand-in. A new client when not given.
+        staging_table (bigquery.Table): The table from prepare_staging, created here when not given.
+    """
     time_now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     print ()
     print ("Rebuilding Data Table in bigquery (" + time_now + ")")
 
-    client = bigquery.Client(credentials=credentials, project=project)
+    if client is None:
+        client = bigquery.Client(credentials=credentials, project=project)
 
-    project_id = "api-integrations-412107"
-    dataset_id = "usa_recruitment_dashboard"
-    table_id = "main"
+    project_id = bigquery_project
+    dataset_id = tenant().dataset
+    table_id = bigquery_table
             
     def delete_table_data(project_id, dataset_id, table_id):
         query = f"DELETE FROM `{project_id}.{dataset_id}.{table_id}` WHERE TRUE"
@@ -717,36 +2079,262 @@ def reload_bigquery():
         job.result()  # Wait for the job to complete
         print(f"Data loaded into {table_id}")
 
-    
-    delete_table_data(project_id, dataset_id, table_id)
-    load_data(looker_data,project_id, dataset_id,table_id)
+    def load_and_swap(data, staging_table, project_id, dataset_id, table_id):
+        buffer = io.BytesIO()
+        pq.write_table(looker_arrow(data, staging_table.schema), buffer)
+        buffer.seek(0)
 
-if __name__ == "__main__":
-    credentials, project = google_auth()
+        load_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.PARQUET,
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+            schema=staging_table.schema,
+        )
+        client.load_table_from_file(buffer, staging_table, job_config=load_config).result()
+        print(f"Data loaded into {staging_table.table_id}")
 
-    client_id = get_secrets("ADP-usa-client-id")
-    client_secret = get_secrets("ADP-usa-client-secret")
-    keyfile = get_secrets("usa_cert_key")
-    certfile = get_secrets("usa_cert_pem")
+        copy_config = bigquery.CopyJobConfig(write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
+        client.copy_table(staging_table, f"{project_id}.{dataset_id}.{table_id}", job_config=copy_config).result()
+        print(f"{table_id} replaced from {staging_table.table_id}")
 
-    temp_certfile, temp_keyfile = load_ssl(certfile, keyfile)
+    tenant().metrics.records(records_in=len(looker_data), records_out=len(looker_data))
 
-    access_token  = security(client_id, client_secret,temp_keyfile,temp_certfile)
+    if bigquery_load_mode == "staging":
+        if staging_table is None:
+            staging_table = prepare_staging(client)
+        load_and_swap(looker_data, staging_table, project_id, dataset_id, table_id)
+    else:
+        delete_table_data(project_id, dataset_id, table_id)
+        load_data(looker_data,project_id, dataset_id,table_id)
 
-    current_staff                                                                                           = GET_staff_adp()
-    adp_applications                                                                                        = GET_applicants_adp(current_staff)
+def run_stages(stages):
+    """
+    Run pipeline stages as a dependency graph, starting each stage as soon as everything it depends on has finished.
 
-    if testing is False:
-        adp_reqs                                                                                                = GET_reqs()
-    if testing:
+    Args:
+        stages (dict): Stage name -> (function, [dependency names]). The function is called with the results
+            of its dependencies, in the order they are listed.
+
+    Returns:
+        dict: Stage name -> the value its function returned.
+    """
+    results = {}
+    started = {}
+    finished = {}
+    pending = dict(stages)
+    running = {}
+    run_start = time.perf_counter()
+
+    def run_stage(name, function, *args):
+        with tenant().metrics.stage(name):
+            return function(*args)
+
+    with ThreadPoolExecutor(max_workers=len(stages)) as pool:
+        while pending or running:
+            for name, (function, dependencies) in list(pending.items()):
+                if all(dependency in results for dependency in dependencies):
+                    del pending[name]
+                    started[name] = time.perf_counter()
+                    running[pool.submit(contextvars.copy_context().run, run_stage, name, function, *[results[dependency] for dependency in dependencies])] = name
+
+            if not running:
+                raise Exception(f"❌ Stages can never start (missing or circular dependencies): {', '.join(pending)}")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                finished[name] = time.perf_counter()
+                results[name] = future.result()                                                                         #re-raises the stage's exception and stops the run
+
+    # Walk back from the last stage to finish, always through the dependency that finished last
+    path = []
+    name = max(finished, key=finished.get)
+    while name:
+        path.append(name)
+        dependencies = stages[name][1]
+        name = max(dependencies, key=finished.get) if dependencies else None
+
+    print()
+    print(f"    Critical path ({finished[path[0]] - run_start:.1f}s wall time):")
+    for name in reversed(path):
+        print(f"        {name:<16}{finished[name] - started[name]:>8.1f}s")
+
+    return results
+
+def run_tenants(countries, run):
+    """
+    Run the pipeline for several countries side by side, tenant_workers at a time, each in its own
+    context with its Tenant active. A country that fails does not stop the others.
+
+    Args:
+        countries (list): Keys of tenants.
+        run (callable): Runs the whole pipeline for the active tenant.
+    """
+    def run_country(name):
+        active_tenant.set(Tenant.configured(name))
+        try:
+            run()
+        finally:
+            if run_report:
+                print()
+                print(f"    Run report ({name}): {tenant().metrics.write(os.path.join(tenant().data_store, 'run_reports'))}")
+
+    with ThreadPoolExecutor(max_workers=max(1, min(tenant_workers, len(countries)))) as pool:
+        runs = {name: pool.submit(contextvars.copy_context().run, run_country, name) for name in countries}
+
+    failed = [name for name, future in runs.items() if future.exception()]
+    if failed and len(countries) > 1:
+        for name in failed:
+            print(f"❌ {name} failed: {runs[name].exception()}")
+    for name in failed:
+        runs[name].result()                                                                                         #re-raises the first failure, once every country has finished
+
+def launch_tasks(count, arguments):
+    """
+    Run a sharded job locally: count copies of main.py side by side, each given the Cloud Run
+    variables a task of one execution gets.
+
+    Args:
+        count (int): Tasks to launch.
+        arguments (list): Command line passed on to every task.
+
+    Raises:
+        Exception: A task exited with an error, once all of them have finished.
+    """
+    execution = f"local-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+    tasks = [
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), *arguments], env={
+            **os.environ,
+            "CLOUD_RUN_TASK_INDEX": str(index),
+            "CLOUD_RUN_TASK_COUNT": str(count),
+            "CLOUD_RUN_EXECUTION": execution,
+        })
+        for index in range(count)
+    ]
+    failed = [str(index) for index, task in enumerate(tasks) if task.wait() != 0]
+    if failed:
+        raise Exception(f"❌ Task {', '.join(failed)} of {execution} failed")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract recruitment data from ADP and reload the dashboard table in BigQuery")
+    parser.add_argument("--full-refresh", action="store_true", help="ignore saved snapshots and re-pull every ADP record")
+    parser.add_argument("--cache", action="store_true", help="serve repeat ADP page requests from the local response cache")
+    parser.add_argument("--record", action="store_true", help="record every ADP exchange, scrubbed, for stand_in.py to replay")
+    parser.add_argument("--stand-in", metavar="URL", help="run against a stand_in.py server with no Secret Manager or BigQuery, e.g. http://127.0.0.1:8080")
+    parser.add_argument("--structured-logs", action="store_true", help="also print Cloud Logging style JSON lines")
+    parser.add_argument("--resume", action="store_true", help="reuse the pages an interrupted run checkpointed and fetch only the rest")
+    parser.add_argument("--profile-startup", action="store_true", help="report what each import costs at startup and on first use, then exit")
+    parser.add_argument("--countries", nargs="+", metavar="COUNTRY", help=f"run these countries side by side in one process (configured: {', '.join(tenants)})")
+    parser.add_argument("--tasks", type=int, metavar="N", help="shard the extraction across N local processes, as a Cloud Run job with N tasks would")
+    parser.add_argument("--reduce", action="store_true", help="only transform and load the shards CLOUD_RUN_EXECUTION's tasks left, e.g. after rerunning a failed task")
+    args = parser.parse_args()
+
+    if args.profile_startup:
+        profile_startup("main", [secretmanager, pd, pa, pc, pq, bigquery, stand_in], cwd=current_folder)
+        raise SystemExit(0)
+    if args.tasks:
+        passed_on = [argument for index, argument in enumerate(sys.argv[1:]) if not argument.startswith("--tasks") and sys.argv[index] != "--tasks"]
+        launch_tasks(args.tasks, passed_on)
+        raise SystemExit(0)
+    if (task_count > 1 or args.reduce) and not task_execution:
+        raise Exception("❌ A sharded run needs CLOUD_RUN_EXECUTION to name it, so its tasks find each other's shards")
+    if task_count > 1 and not shard_store and os.getenv("CLOUD_RUN_JOB"):
+        raise Exception("❌ Each Cloud Run task has a disk of its own, set SHARD_STORE to a folder they share (a Cloud Storage volume mount)")
+    if os.getenv("CLOUD_RUN_JOB") and not os.getenv("STATE_STORE"):
+        print("⚠️ STATE_STORE is not set, snapshots, sync state, the response cache and checkpoints are lost when this execution ends, so every run is a full extract")
+    warm_up(*([pd] if Data_export or bigquery_load_mode == "dml" else []), pa, pc, pq)          #pandas is only used for exports and the dml load, bigquery and secretmanager load in stages that start straight away
+    resume = resume or args.resume
+    structured_logs = structured_logs or args.structured_logs
+    full_refresh = full_refresh or args.full_refresh
+    response_cache = response_cache or args.cache
+    record_exchanges = record_exchanges or args.record
+
+    if args.stand_in:
+        adp_base_url = args.stand_in.rstrip("/")
+        adp_token_url = f"{adp_base_url}/auth/oauth/v2/token"
+        credentials, project = None, None
+    else:
+        credentials, project = google_auth()
+
+    def secret(secret_id):
+        if args.stand_in:
+            return f"stand-in {secret_id}"
+        return get_secrets(secret_id)
+
+    countries = args.countries or [country]
+
+    def connect(certfile, keyfile, client_id, client_secret):
+        tenant().adp = adp_client(None if args.stand_in else load_ssl(certfile, keyfile))
+        return security(client_id, client_secret, tenant().adp)
+
+    bigquery_lock = threading.Lock()
+    bigquery_clients = []
+
+    def bigquery_client():
+        with bigquery_lock:                                                                                         #one client for every country, made by whichever asks first
+            if not bigquery_clients:
+                if args.stand_in:
+                    bigquery_clients.append(stand_in.LocalBigQueryClient({f"{bigquery_project}.{tenants[name]['dataset']}.{bigquery_table}": (stand_in.DASHBOARD_SCHEMA, []) for name in countries}))
+                else:
+                    bigquery_clients.append(bigquery.Client(credentials=credentials, project=project))
+            return bigquery_clients[0]
+
+    def requisitions(access_token):
+        if testing is False:
+            return GET_reqs()
         print ("Loading data from saved requisitions")
-        file_path = os.path.join(data_store,"003 - Requisitions.json")
-        with open(file_path, "r") as file:
-            adp_reqs = json.load(file)
+        return [Requisition.from_dict(record) for record in replay_snapshot("003 - Requisitions")]
+
+    def run():
+        secret_ids = tenants[tenant().country]["secrets"]
+        adp_stages = {
+            "client_id":        (lambda: secret(secret_ids["client_id"]), []),
+            "client_secret":    (lambda: secret(secret_ids["client_secret"]), []),
+            "keyfile":          (lambda: secret(secret_ids["keyfile"]), []),
+            "certfile":         (lambda: secret(secret_ids["certfile"]), []),
+            "security":         (connect, ["certfile", "keyfile", "client_id", "client_secret"]),
+        }
+
+        if task_count > 1 and not args.reduce:
+            run_stages({
+                **adp_stages,
+                "extract_staff":        (lambda access_token: extract_shard(f'{adp_base_url}/hr/v2/workers', 100, "workers"), ["security"]),
+                "extract_applications": (lambda access_token: extract_shard(f'{adp_base_url}/staffing/v2/job-applications', 20, "jobApplications"), ["security"]),
+                "extract_requisitions": (lambda access_token: extract_shard(f'{adp_base_url}/staffing/v1/job-requisitions', 20, "jobRequisitions"), ["security"]),
+            })                                                                                                      #named apart from the reduce stages, so a task that goes on to reduce reports both phases
+            clear_checkpoints()
+            if not claim_reduce():
+                print()
+                print(f"    Task {task_index} of {task_count} extracted its shards, the last task to finish loads them")
+                return
+        tenant().reducing = task_count > 1 or args.reduce
+        source = "security"
+        if tenant().reducing:
+            print()
+            print(f"    Reducing the shards in {shard_folder()}")
+            adp_stages = {"shards": (lambda: None, [])}                                                            #the tasks have fetched everything, the reducer only reads their shards
+            source = "shards"
+
+        try:
+            run_stages({
+                **adp_stages,
+                "staff":            (lambda access_token: GET_staff_adp(), [source]),
+                "applications":     (lambda access_token: GET_applicants_adp(), [source]),
+                "requisitions":     (requisitions, [source]),
+                "matching":         (match_applicants, ["applications", "staff"]),
+                "filter":           (filter_adp, ["matching", "requisitions"]),
+                "bigquery_client":  (bigquery_client, []),
+                "staging":          (prepare_staging, ["bigquery_client"]),
+                "bigquery":         (reload_bigquery, ["filter", "bigquery_client", "staging"]),
+            })
+        except BaseException:
+            if tenant().reducing and task_count > 1:
+                release_reduce()                                                                                    #so the retry Cloud Run makes of this task reduces again rather than exiting 0
+            raise
+        clear_checkpoints()
+        if tenant().reducing:
+            clear_shards()
 
-    looker_data                                                                                             = filter_adp(adp_applications,adp_reqs)
-    reload_bigquery()
+    run_tenants(countries, run)
 
     time_now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     print ("    Finishing Up (" + time_now + ")")
-
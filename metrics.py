@@ -0,0 +1,244 @@
+import json
+import os
+import sys
+import threading
+import time
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+try:
+    import resource
+except ImportError:                                 #Windows, peak RSS is reported as None
+    resource = None
+
+
+LATENCY_BUCKETS_MS = [50, 100, 250, 500, 1000, 2500, 5000, 10000]     #upper bounds, anything slower lands in the last ">10000" bucket
+
+
+def peak_rss_mb():
+    """
+    Highest resident set size the process has reached so far (ru_maxrss is KB on Linux, bytes on macOS).
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024, 1)
+
+def percentile(values, share):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+class RunMetrics:
+    """
+    Collects per-stage and per-ADP-endpoint metrics for one pipeline run.
+
+    Stages are timed with stage(), which also makes them the current stage of their thread, so
+    record counts reported from inside a stage (records(), counted()) land on it without the
+    stage name being passed around. ADP calls are reported with request() from any thread.
+
+    With structured on, stage starts and ends are also printed as one-line JSON in the shape
+    Cloud Logging parses from stdout (severity, message, plus the fields). labels (e.g. the
+    country when several run in one process) go on every log line and into the report.
+    """
+    def __init__(self, structured=False, labels=None):
+        self.structured = structured
+        self.labels = labels or {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = datetime.now(timezone.utc)
+        self.run_start = time.perf_counter()
+        self.stages = {}
+        self.endpoints = {}
+
+    def log(self, message, severity="INFO", **fields):
+        if self.structured:
+            print(json.dumps({"severity": severity, "message": message, "time": datetime.now(timezone.utc).isoformat(), **self.labels, **fields}, default=str), flush=True)
+
+    def current(self):
+        """
+        The metrics of the stage running on this thread (a "main" stage outside of stage()).
+        """
+        name = getattr(self.local, "stage", None) or "main"
+        with self.lock:
+            return self.stages.setdefault(name, {"records_in": 0, "records_out": 0, "dead_letters": 0})
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time a stage and make it the current stage of this thread while it runs.
+        """
+        previous = getattr(self.local, "stage", None)
+        self.local.stage = name
+        stage = self.current()
+        stage["started_s"] = round(time.perf_counter() - self.run_start, 3)
+        start = time.perf_counter()
+        self.log(f"{name} started", stage=name)
+        try:
+            yield stage
+        except BaseException as error:
+            stage["error"] = repr(error)
+            raise
+        finally:
+            stage["wall_s"] = round(time.perf_counter() - start, 3)
+            stage["peak_rss_mb"] = peak_rss_mb()
+            self.local.stage = previous
+            self.log(f"{name} finished", severity="ERROR" if "error" in stage else "INFO", stage=name, **{key: value for key, value in stage.items() if key != "started_s"})
+
+    def records(self, records_in=0, records_out=0, dead_letters=0):
+        stage = self.current()
+        stage["records_in"] += records_in
+        stage["records_out"] += records_out
+        stage["dead_letters"] += dead_letters
+
+    def counted(self, records):
+        """
+        Pass records through, counting them as records_in of the current stage.
+        """
+        stage = self.current()
+        for record in records:
+            stage["records_in"] += 1
+            yield record
+
+    def endpoint(self, endpoint):
+        return self.endpoints.setdefault(endpoint, {
+            "requests": 0,
+            "records": 0,
+            "bytes": 0,
+            "wire_bytes": 0,
+            "select": None,
+            "retries": 0,
+            "cache_hits": 0,
+            "checkpoint_hits": 0,
+            "status_codes": {},
+            "latencies_ms": [],
+        })
+
+    def request(self, endpoint, seconds, status_code, bytes_received=0, wire_bytes=None):
+        """
+        Record one HTTP exchange with an ADP endpoint.
+
+        bytes_received is the decoded body, wire_bytes what actually crossed the network when the
+        body came compressed (the same as bytes_received when not given).
+        """
+        with self.lock:
+            metrics = self.endpoint(endpoint)
+            metrics["requests"] += 1
+            metrics["bytes"] += bytes_received
+            metrics["wire_bytes"] += bytes_received if wire_bytes is None else wire_bytes
+            metrics["status_codes"][str(status_code)] = metrics["status_codes"].get(str(status_code), 0) + 1
+            metrics["latencies_ms"].append(seconds * 1000)
+
+    def page(self, endpoint, records):
+        """
+        Count the records of a page ADP sent, so the bytes per record can be compared across runs.
+        """
+        with self.lock:
+            self.endpoint(endpoint)["records"] += records
+
+    def retry(self, endpoint):
+        with self.lock:
+            self.endpoint(endpoint)["retries"] += 1
+
+    def cache_hit(self, endpoint):
+        with self.lock:
+            self.endpoint(endpoint)["cache_hits"] += 1
+
+    def selection(self, endpoint, applied):
+        """
+        Note whether the endpoint took the $select projection ("applied") or rejected it ("rejected").
+        """
+        with self.lock:
+            self.endpoint(endpoint)["select"] = "applied" if applied else "rejected"
+
+    def checkpoint_hit(self, endpoint):
+        with self.lock:
+            self.endpoint(endpoint)["checkpoint_hits"] += 1
+
+    def report(self, baselines=None):
+        """
+        Build the run report.
+
+        compression_saved is what gzip saved on the wire. select_saved is what $select saved,
+        estimated from the bytes per record of a run that fetched whole records (baselines), and
+        None when $select was not applied or there is no such run yet.
+
+        Args:
+            baselines (dict): Endpoint -> bytes per whole record, see select_baselines().
+
+        Returns:
+            dict: Run totals, then "stages" and "endpoints". Raw latencies are summarised as a
+                histogram over LATENCY_BUCKETS_MS and p50/p95/max.
+        """
+        baselines = baselines or {}
+        with self.lock:
+            endpoints = {}
+            for endpoint, metrics in self.endpoints.items():
+                latencies = metrics["latencies_ms"]
+                histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+                for latency in latencies:
+                    histogram[bisect_left(LATENCY_BUCKETS_MS, latency)] += 1
+                endpoints[endpoint] = {
+                    **{key: value for key, value in metrics.items() if key != "latencies_ms"},
+                    "compression_saved": metrics["bytes"] - metrics["wire_bytes"],
+                    "select_baseline_bytes_per_record": baselines.get(endpoint),
+                    "select_saved": (round(metrics["records"] * baselines[endpoint]) - metrics["bytes"]
+                                     if metrics["select"] == "applied" and endpoint in baselines else None),
+                    "latency_ms": {
+                        "p50": round(percentile(latencies, 0.5), 1) if latencies else None,
+                        "p95": round(percentile(latencies, 0.95), 1) if latencies else None,
+                        "max": round(max(latencies), 1) if latencies else None,
+                        "histogram": {
+                            **{f"<={bound}": count for bound, count in zip(LATENCY_BUCKETS_MS, histogram)},
+                            f">{LATENCY_BUCKETS_MS[-1]}": histogram[-1],
+                        },
+                    },
+                }
+
+            return {
+                **self.labels,
+                "started": self.started.isoformat(),
+                "wall_s": round(time.perf_counter() - self.run_start, 3),
+                "peak_rss_mb": peak_rss_mb(),
+                "stages": {name: dict(stage) for name, stage in self.stages.items()},
+                "endpoints": endpoints,
+            }
+
+    @staticmethod
+    def select_baselines(folder):
+        """
+        Bytes per record of each endpoint in the latest earlier report in folder that fetched it
+        without $select, i.e. what a whole record costs.
+        """
+        baselines = {}
+        if not os.path.isdir(folder):
+            return baselines
+        for name in sorted(os.listdir(folder), reverse=True):
+            if not (name.startswith("run-") and name.endswith(".json")):
+                continue
+            try:
+                with open(os.path.join(folder, name), "r") as file:
+                    endpoints = json.load(file).get("endpoints", {})
+            except (OSError, ValueError):
+                continue
+            for endpoint, metrics in endpoints.items():
+                if endpoint not in baselines and metrics.get("select") != "applied" and metrics.get("records"):
+                    baselines[endpoint] = metrics["bytes"] / metrics["records"]
+        return baselines
+
+    def write(self, folder):
+        """
+        Write the run report to folder/run-<start time>[-<label>-<value>...].json and return its path.
+        The labels keep apart the reports of countries or tasks that started in the same second.
+        """
+        os.makedirs(folder, exist_ok=True)
+        name = "-".join([f"run-{self.started.strftime('%Y%m%d-%H%M%S')}", *(f"{label}-{value}" for label, value in self.labels.items())])
+        path = os.path.join(folder, f"{name}.json")
+        report = self.report(self.select_baselines(folder))
+        with open(path, "w") as outfile:
+            json.dump(report, outfile, indent=4)
+        self.log("run report written", path=path, wall_s=report["wall_s"], peak_rss_mb=report["peak_rss_mb"])
+        return path
@@ -0,0 +1,114 @@
+from datetime import date
+
+
+def parse_date(value):
+    """
+    A "YYYY-MM-DD" string (anything after the tenth character is ignored) as a date, None when it is empty or does not parse.
+    """
+    if not value or not isinstance(value, str):
+        return None
+    try:
+        return date.fromisoformat(value[:10])
+    except ValueError:
+        return None
+
+def format_date(value):
+    return value.isoformat() if value else None
+
+class Staff:
+    """
+    One ADP worker as the pipeline uses it, with its dates parsed when the record is built.
+
+    as_dict() gives the shape the staff snapshots have always been exported in.
+    """
+    __slots__ = ("forename", "middle_name", "preferred_name", "surname", "status", "birth_date", "address", "hire_date", "manager")
+
+    def __init__(self, forename, middle_name, preferred_name, surname, status, birth_date, address, hire_date, manager):
+        self.forename = forename
+        self.middle_name = middle_name
+        self.preferred_name = preferred_name
+        self.surname = surname
+        self.status = status
+        self.birth_date = parse_date(birth_date)
+        self.address = address
+        self.hire_date = parse_date(hire_date)
+        self.manager = manager                      #"Surname, Forename" as ADP formats reportsTo
+
+    def as_dict(self):
+        return {
+            "Forename": self.forename,
+            "MiddleName": self.middle_name,
+            "givenName": self.forename,
+            "prefferedName": self.preferred_name,
+            "Surname": self.surname,
+            "Status": self.status,
+            "BirthDate": format_date(self.birth_date),
+            "Address": self.address,
+            "Hire Date": format_date(self.hire_date),
+            "Manager": self.manager,
+        }
+
+class Application:
+    """
+    One ADP job application, with its dates parsed when the record is built. match_made is set by match_applicants.
+    """
+    __slots__ = ("candidate_name", "forename", "surname", "dob", "status", "job_title", "hiring_manager", "line_manager",
+                 "recruiter", "requisition_id", "start_date", "address", "match_made")
+
+    def __init__(self, candidate_name, forename, surname, dob, status, job_title, hiring_manager, line_manager,
+                 recruiter, requisition_id, start_date, address, match_made=None):
+        self.candidate_name = candidate_name
+        self.forename = forename
+        self.surname = surname
+        self.dob = parse_date(dob)
+        self.status = status
+        self.job_title = job_title
+        self.hiring_manager = hiring_manager
+        self.line_manager = line_manager            #"Forename Surname", from line_manager_name
+        self.recruiter = recruiter
+        self.requisition_id = requisition_id
+        self.start_date = parse_date(start_date)
+        self.address = address
+        self.match_made = match_made
+
+    def as_dict(self):
+        return {
+            "CandidateName": self.candidate_name,
+            "forename": self.forename,
+            "surname": self.surname,
+            "DOB": format_date(self.dob),
+            "ApplicationStatus": self.status,
+            "JobTitle": self.job_title,
+            "HiringManager": self.hiring_manager,
+            "LineManager": self.line_manager,
+            "Recruiter": self.recruiter,
+            "Requisition_ID": self.requisition_id,
+            "Start Date": format_date(self.start_date),
+            "Address": self.address,
+            "Match Made": self.match_made,
+        }
+
+class Requisition:
+    """
+    One ADP job requisition, with its posting date parsed when the record is built.
+    """
+    __slots__ = ("requisition_id", "posted_date", "req_type")
+
+    def __init__(self, requisition_id, posted_date, req_type):
+        self.requisition_id = requisition_id
+        self.posted_date = parse_date(posted_date)
+        self.req_type = req_type
+
+    def as_dict(self):
+        return {
+            "Requisition ID": self.requisition_id,
+            "Posted Date": format_date(self.posted_date),
+            "req_type": self.req_type,
+        }
+
+    @classmethod
+    def from_dict(cls, record):
+        """
+        Rebuild a requisition from its as_dict() form, e.g. the "003 - Requisitions" snapshot testing mode replays.
+        """
+        return cls(record["Requisition ID"], record["Posted Date"], record["req_type"])
@@ -0,0 +1,475 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import random
+import re
+import secrets
+import threading
+import time
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from collections import Counter, defaultdict
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from google.api_core.exceptions import NotFound
+from google.cloud import bigquery
+
+
+DASHBOARD_SCHEMA = [                                #Columns of the dashboard table, for running without BigQuery
+    bigquery.SchemaField("CandidateName", "STRING"),
+    bigquery.SchemaField("ApplicationStatus", "STRING"),
+    bigquery.SchemaField("JobTitle", "STRING"),
+    bigquery.SchemaField("HiringManager", "STRING"),
+    bigquery.SchemaField("Recruiter", "STRING"),
+    bigquery.SchemaField("RequisitionCreateDate", "DATE"),
+    bigquery.SchemaField("DateofHire", "DATE"),
+    bigquery.SchemaField("DaystoHire", "INTEGER"),
+    bigquery.SchemaField("StillEmployed", "BOOLEAN"),
+    bigquery.SchemaField("ReqType", "STRING"),
+]
+
+
+class LocalJob:
+    """
+    A finished BigQuery job; result() returns straight away like a completed real one.
+    """
+    def __init__(self, job_type, destination=None):
+        self.job_type = job_type
+        self.destination = destination
+
+    def result(self):
+        return self
+
+class LocalBigQueryClient:
+    """
+    Stand-in for google.cloud.bigquery.Client covering the calls main.py makes.
+
+    Tables are held in memory as (bigquery.Table, pyarrow.Table) pairs keyed by "project.dataset.table".
+    Every job is appended to `jobs`, and `row_counts` records the row count of every table after each
+    job, so a run can be checked for moments where the dashboard table was empty.
+    """
+    def __init__(self, tables=None):
+        self.tables = {}
+        self.jobs = []
+        self.row_counts = []
+        for table_ref, (schema, rows) in (tables or {}).items():
+            table = bigquery.Table(table_ref, schema=schema)
+            self.tables[table_ref] = (table, self.to_arrow(rows, schema))
+
+    @staticmethod
+    def table_ref(table):
+        if isinstance(table, (bigquery.Table, bigquery.TableReference)):
+            return f"{table.project}.{table.dataset_id}.{table.table_id}"
+        return str(table)
+
+    @staticmethod
+    def to_arrow(rows, schema):
+        if rows:
+            return pa.Table.from_pylist(rows)
+        return pa.table({field.name: pa.array([], pa.string()) for field in schema})
+
+    def rows(self, table):
+        """
+        Return a table's rows as dicts.
+        """
+        return self.tables[self.table_ref(table)][1].to_pylist()
+
+    def record(self, job):
+        self.jobs.append(job)
+        self.row_counts.append({table_ref: data.num_rows for table_ref, (_, data) in self.tables.items()})
+        return job
+
+    def get_table(self, table):
+        table_ref = self.table_ref(table)
+        if table_ref not in self.tables:
+            raise NotFound(f"Not found: Table {table_ref}")
+        return self.tables[table_ref][0]
+
+    def create_table(self, table, exists_ok=False):
+        table_ref = self.table_ref(table)
+        if table_ref in self.tables:
+            if not exists_ok:
+                raise ValueError(f"Already Exists: Table {table_ref}")
+            return self.tables[table_ref][0]
+        self.tables[table_ref] = (table, self.to_arrow([], table.schema))
+        return table
+
+    def delete_table(self, table, not_found_ok=False):
+        table_ref = self.table_ref(table)
+        if table_ref not in self.tables:
+            if not_found_ok:
+                return
+            raise NotFound(f"Not found: Table {table_ref}")
+        del self.tables[table_ref]
+
+    def load_table_from_file(self, file_obj, destination, job_config=None):
+        table_ref = self.table_ref(destination)
+        table, existing = self.tables[table_ref]
+        loaded = pq.read_table(file_obj)
+        if job_config is None or job_config.write_disposition != bigquery.WriteDisposition.WRITE_TRUNCATE:
+            loaded = pa.concat_tables([existing, loaded], promote_options="permissive")
+        self.tables[table_ref] = (table, loaded)
+        return self.record(LocalJob("load", table_ref))
+
+    def load_table_from_dataframe(self, dataframe, destination, job_config=None):
+        table_ref = self.table_ref(destination)
+        table, existing = self.tables[table_ref]
+        loaded = pa.Table.from_pandas(dataframe, preserve_index=False)
+        if existing.num_rows:
+            loaded = pa.concat_tables([existing, loaded], promote_options="permissive")
+        self.tables[table_ref] = (table, loaded)
+        return self.record(LocalJob("load", table_ref))
+
+    def copy_table(self, sources, destination, job_config=None):
+        source_ref = self.table_ref(sources)
+        destination_ref = self.table_ref(destination)
+        table = self.tables[destination_ref][0] if destination_ref in self.tables else bigquery.Table(destination_ref)
+        self.tables[destination_ref] = (table, self.tables[source_ref][1])
+        return self.record(LocalJob("copy", destination_ref))
+
+    def query(self, query):
+        match = re.fullmatch(r"\s*DELETE FROM `([^`]+)` WHERE TRUE\s*", query)
+        if not match:
+            raise NotImplementedError(f"LocalBigQueryClient only understands full-table deletes: {query}")
+        table, data = self.tables[match.group(1)]
+        self.tables[match.group(1)] = (table, data.slice(0, 0))
+        return self.record(LocalJob("query", match.group(1)))
+
+PSEUDONYM_CONSONANTS = "bcdfghjklmnprstvz"
+PSEUDONYM_VOWELS = "aeiou"
+
+def pseudonym(salt, word):
+    """
+    Replace one word with a made-up one, always the same for the same word and salt.
+
+    Digits become digits and the capitalisation pattern is kept, so "Smith, JOHN" and
+    "12 Main Street" keep their shape and the same person still matches across endpoints.
+    """
+    digest = hashlib.sha256(f"{salt}:{word.lower()}".encode("utf-8")).digest()
+    if word.isdigit():
+        return "".join(str(byte % 10) for byte in digest[:len(word)])
+    letters = "".join(
+        PSEUDONYM_CONSONANTS[digest[index] % len(PSEUDONYM_CONSONANTS)] + PSEUDONYM_VOWELS[digest[index + 1] % len(PSEUDONYM_VOWELS)]
+        for index in range(0, 2 * max(2, min(len(word), 8) // 2), 2)
+    )
+    if word.isupper() and len(word) > 1:
+        return letters.upper()
+    if word[0].isupper():
+        return letters.capitalize()
+    return letters
+
+PERSONAL_FIELDS = {                                 #Kept fields holding personal data, pseudonymised wherever they appear in a recorded body
+    "givenName", "middleName", "familyName1", "familyName2", "formattedName", "nickName",
+    "lineOne", "lineTwo", "lineThree", "postalCode", "emailUri", "formattedNumber", "dialNumber",
+    "idValue", "associateOID", "access_token",
+}
+PERSONAL_DATES = {"birthDate"}
+
+def scrub(value, salt, key=None):
+    """
+    Return a copy of a decoded ADP body with personal data replaced by stable pseudonyms.
+
+    Birth dates are moved to another (stable) day in the same format, so DOB comparisons still line up.
+    """
+    if isinstance(value, dict):
+        return {field: scrub(item, salt, field) for field, item in value.items()}
+    if isinstance(value, list):
+        return [scrub(item, salt, key) for item in value]
+    if not isinstance(value, str) or not value:
+        return value
+    if key in PERSONAL_DATES and re.match(r"\d{4}-\d{2}-\d{2}", value):
+        digest = hashlib.sha256(f"{salt}:{value[:10]}".encode("utf-8")).digest()
+        day = date(1950, 1, 1) + timedelta(days=int.from_bytes(digest[:4], "big") % (50 * 365))
+        return day.isoformat() + value[10:]
+    if key in PERSONAL_FIELDS:
+        return re.sub(r"[^\W_]+", lambda match: pseudonym(salt, match.group()), value)
+    return value
+
+class ExchangeRecorder:
+    """
+    requests response hook that appends every ADP exchange to data_store/recordings/<endpoint>.jsonl.
+
+    Each line holds the method, path, query parameters, status, the headers the pipeline reads and
+    the records of the decoded body. Only the fields named for the endpoint in fields are kept (the
+    pipeline passes its record_fields), anything else, such as pay, gender, ethnicity, disability or
+    veteran status, is dropped before it reaches disk. Names, addresses, IDs and birth dates among
+    the kept fields are then scrubbed. Bodies of other endpoints (the token) and request bodies
+    (the client secret) are never written. The folder is cleared when recording starts, so it
+    always holds exactly one run.
+    """
+    def __init__(self, folder, fields, salt=None):
+        self.folder = folder
+        self.fields = fields
+        self.salt = salt or os.getenv("STAND_IN_SALT") or secrets.token_hex(16)
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        for name in os.listdir(folder):
+            if name.endswith(".jsonl"):
+                os.remove(os.path.join(folder, name))
+
+    def kept(self, endpoint, body):
+        # Just the records, cut down to the endpoint's fields
+        if endpoint not in self.fields or not isinstance(body, dict):
+            return None
+        return {key: [selected(record, self.fields[endpoint]) for record in value] for key, value in body.items() if isinstance(value, list)}
+
+    def __call__(self, response, *args, **kwargs):
+        url = urlsplit(response.request.url)
+        endpoint = url.path.rstrip("/").rsplit("/", 1)[-1] or "root"
+        body = None
+        if response.status_code == 200 and response.content:
+            try:
+                body = scrub(self.kept(endpoint, response.json()), self.salt)
+            except ValueError:
+                body = None
+        exchange = {
+            "method": response.request.method,
+            "path": url.path,
+            "params": dict(parse_qsl(url.query)),
+            "status_code": response.status_code,
+            "headers": {name: response.headers[name] for name in ("Content-Type", "ETag", "Retry-After") if name in response.headers},
+            "body": body,
+        }
+        with self.lock:
+            with open(os.path.join(self.folder, f"{endpoint}.jsonl"), "a") as outfile:
+                outfile.write(json.dumps(exchange) + "\n")
+        return response
+
+def load_recordings(folder):
+    """
+    Rebuild each recorded endpoint's full record list from its recorded pages.
+
+    Pages are put back in $skip order, so the stand-in can serve them again with any $top. Where an
+    endpoint was pulled with several $filters (delta syncs), the unfiltered pull is used if there is
+    one, otherwise the largest.
+
+    Returns:
+        dict: path -> (records_key, list of records).
+    """
+    pages = defaultdict(dict)
+    for name in sorted(os.listdir(folder)):
+        if not name.endswith(".jsonl"):
+            continue
+        with open(os.path.join(folder, name)) as file:
+            for line in file:
+                exchange = json.loads(line)
+                body = exchange["body"]
+                params = exchange["params"]
+                if exchange["method"] != "GET" or exchange["status_code"] != 200 or not isinstance(body, dict) or (params.get("count") == "true" and "$skip" not in params):
+                    continue
+                records_key = next((key for key, value in body.items() if isinstance(value, list)), None)
+                if records_key:
+                    pages[exchange["path"]][(params.get("$filter"), int(params.get("$skip", 0)))] = (records_key, body[records_key])
+
+    endpoints = {}
+    for path, recorded in pages.items():
+        pulls = defaultdict(list)
+        for (api_filter, _), page in sorted(recorded.items(), key=lambda item: (str(item[0][0]), item[0][1])):
+            pulls[api_filter].append(page)
+        pull = pulls[None] if None in pulls else max(pulls.values(), key=lambda pull: sum(len(records) for _, records in pull))
+        endpoints[path] = (pull[0][0], [record for _, records in pull for record in records])
+
+    return endpoints
+
+def selection(records_key, select):
+    """
+    Turn $select paths ("workers/person/legalName,...") into a nested spec of the parts to keep.
+    """
+    spec = {}
+    for path in select.split(","):
+        parts = path.strip().split("/")
+        if parts[0] != records_key or len(parts) < 2:
+            continue
+        node = spec
+        for part in parts[1:-1]:
+            node = node.setdefault(part, {})
+            if node is True:
+                break
+        else:
+            node[parts[-1]] = True
+    return spec
+
+def selected(value, spec):
+    if spec is True or value is None:
+        return value
+    if isinstance(value, list):
+        return [selected(item, spec) for item in value]
+    if isinstance(value, dict):
+        return {key: selected(value[key], below) for key, below in spec.items() if key in value}
+    return value
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"                   #keep-alive, so the session's connection pool behaves as it does against ADP
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status_code, body=None, headers=None):
+        self.server.count(status_code)
+        self.send_response(status_code)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if status_code == 204:
+            self.end_headers()
+            return
+        data = json.dumps(body).encode("utf-8") if body is not None else b""
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            data = gzip.compress(data)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def injected(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        roll = server.roll()
+        if roll < server.throttle_rate:
+            self.send_json(429, {"error": "Too Many Requests"}, {"Retry-After": str(server.retry_after)})
+            return True
+        if roll < server.throttle_rate + server.error_rate:
+            self.send_json(503, {"error": "Service Unavailable"})
+            return True
+        return False
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if not urlsplit(self.path).path.endswith("/token"):
+            self.send_json(404, {"error": f"No recording for {self.path}"})
+        elif not self.injected():
+            access_token, lifetime = self.server.issue_token()
+            self.send_json(200, {"access_token": access_token, "token_type": "Bearer", "expires_in": lifetime})
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path not in self.server.endpoints:
+            self.send_json(404, {"error": f"No recording for {url.path}"})
+            return
+        if self.injected():
+            return
+        if not self.server.token_valid(self.headers.get("Authorization", "")):
+            self.send_json(401, {"error": "invalid_token"})
+            return
+
+        params = dict(parse_qsl(url.query))
+        records_key, records = self.server.endpoints[url.path]
+        top = int(params.get("$top", self.server.default_page_size))
+        if self.server.max_page_size:
+            top = min(top, self.server.max_page_size)
+        skip = int(params.get("$skip", 0))
+        page = records[skip:skip + top]
+        if "$select" in params:
+            if not self.server.select:
+                self.send_json(400, {"error": "$select is not supported on this resource"})
+                return
+            page = selected(page, selection(records_key, params["$select"]))
+
+        if params.get("count") == "true":
+            self.send_json(200, {"meta": {"totalNumber": len(records)}, records_key: page})
+        elif page:
+            self.send_json(200, {records_key: page})
+        else:
+            self.send_json(204)
+
+class StandInADP(ThreadingHTTPServer):
+    """
+    Local HTTP server that replays recorded ADP endpoints, re-paging the recorded records for any $top/$skip.
+
+    Args:
+        recordings (str): Folder written by ExchangeRecorder.
+        address (tuple): Host and port to listen on, port 0 picks a free one.
+        latency (float): Seconds added to every request.
+        max_page_size (int): Largest page returned whatever $top asks for, as ADP caps some endpoints.
+        throttle_rate (float): Share of requests answered 429 with a Retry-After header.
+        error_rate (float): Share of requests answered 503.
+        retry_after (int): Seconds sent in Retry-After.
+        seed (int): Seed for the injected failures, so a run can be repeated exactly.
+        token_lifetime (float): expires_in of the tokens handed out, after which requests using them
+            get a 401. None accepts any request without checking its token.
+        select (bool): Honour $select. False answers any request carrying one with a 400, as ADP
+            resources without $select support do.
+
+    Responses are gzipped when the request accepts it.
+    """
+    daemon_threads = True
+
+    def __init__(self, recordings, address=("127.0.0.1", 0), latency=0.0, max_page_size=None,
+                 throttle_rate=0.0, error_rate=0.0, retry_after=1, seed=None, token_lifetime=None, select=True):
+        self.endpoints = load_recordings(recordings)
+        self.latency = latency
+        self.default_page_size = 100
+        self.max_page_size = max_page_size
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = Counter()
+        self.token_lifetime = token_lifetime
+        self.select = select
+        self.tokens = {}
+        super().__init__(address, StandInHandler)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def roll(self):
+        with self.lock:
+            return self.random.random()
+
+    def issue_token(self):
+        with self.lock:
+            access_token = f"stand-in-token-{len(self.tokens) + 1}"
+            lifetime = self.token_lifetime or 3600
+            self.tokens[access_token] = time.monotonic() + lifetime
+            return access_token, lifetime
+
+    def token_valid(self, authorization):
+        if self.token_lifetime is None:
+            return True
+        with self.lock:
+            return time.monotonic() < self.tokens.get(authorization.removeprefix("Bearer "), 0)
+
+    def count(self, status_code):
+        with self.lock:
+            self.stats[status_code] += 1
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve recorded ADP exchanges locally, for running main.py --stand-in without a network")
+    parser.add_argument("--recordings", default=os.path.join("Data - USA", "recordings"), help="folder written by main.py --record")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--max-page-size", type=int, help="cap on records per page whatever $top asks for")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of requests answered 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered 503")
+    parser.add_argument("--retry-after", type=int, default=1, help="seconds sent in Retry-After with a 429")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--token-lifetime", type=float, help="seconds a token is accepted for (default: tokens are not checked)")
+    parser.add_argument("--no-select", action="store_true", help="answer requests carrying $select with a 400")
+    args = parser.parse_args()
+
+    server = StandInADP(args.recordings, (args.host, args.port), args.latency, args.max_page_size,
+                        args.throttle_rate, args.error_rate, args.retry_after, args.seed, args.token_lifetime, not args.no_select)
+    for path, (records_key, records) in server.endpoints.items():
+        print(f"    {path:<40}{len(records):>8} {records_key}")
+    print(f"Serving on {server.url}, run: python main.py --stand-in {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(dict(server.stats))
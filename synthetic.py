@@ -0,0 +1,272 @@
+import argparse
+import json
+import os
+import random
+
+from datetime import date, timedelta
+
+
+FORENAMES = ["James", "Mary", "Robert", "Patricia", "John", "Jennifer", "Michael", "Linda", "David", "Elizabeth",
+             "William", "Barbara", "Richard", "Susan", "Joseph", "Jessica", "Thomas", "Sarah", "Carlos", "Karen",
+             "Daniel", "Lisa", "Matthew", "Nancy", "Anthony", "Betty", "Mark", "Sandra", "Luis", "Ashley"]
+SURNAMES = ["Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis", "Rodriguez", "Martinez",
+            "Hernandez", "Lopez", "Gonzalez", "Wilson", "Anderson", "Thomas", "Taylor", "Moore", "Jackson", "Martin",
+            "Lee", "Perez", "Thompson", "White", "Harris", "Sanchez", "Clark", "Ramirez", "Lewis", "Robinson"]
+STREETS = ["Main Street", "Oak Avenue", "Maple Drive", "Cedar Lane", "Park Road", "Elm Street", "Lake View", "Hill Court"]
+CITIES = ["Springfield", "Riverside", "Franklin", "Greenville", "Clinton", "Fairview", "Salem", "Madison"]
+JOB_TITLES = ["Direct Support Professional", "Support Worker", "Team Leader", "House Manager", "Registered Nurse",
+              "Behaviour Specialist", "Administrator", "Driver", "Cook", "Regional Director"]
+RECRUITERS = ["Guerrero, Robinson", "Schwartz, Dana", "Peoples, Julia", "Halliday, Robyn", "Ortiz, Sam"]
+APPLICATION_STATUSES = ["Hired", "Offer Accepted", "Offer Extended", "Phone Screening", "Screening Complete",
+                        "Interview", "New", "Declined", "Offer Declined", "Deleted", "Withdrawn"]
+WORKER_STATUSES = ["Active"] * 8 + ["Inactive", "Terminated"]
+
+EPOCH = date(2026, 10, 1)                           #"today" for generated dates, so a seed always produces the same payload
+
+
+def person_name(rng):
+    """
+    A forename and surname. Half the surnames are common ones, the rest a long tail of made-up ones,
+    so names repeat about as often as in a real applicant pool.
+    """
+    if rng.random() < 0.5:
+        surname = rng.choice(SURNAMES)
+    else:
+        surname = "".join(rng.choice("bcdfghklmnprstvw") + rng.choice("aeiou") for _ in range(3)).capitalize() + rng.choice(["", "s", "n", "r", "son"])
+    return rng.choice(FORENAMES), surname
+
+def day(rng, earliest_days_ago, latest_days_ago=0):
+    return (EPOCH - timedelta(days=rng.randint(latest_days_ago, earliest_days_ago))).isoformat()
+
+def worker(rng, number, managers):
+    """
+    One ADP worker, shaped like the /hr/v2/workers records GET_staff_adp reads.
+
+    Args:
+        rng (random.Random): Source of randomness.
+        number (int): Position of the worker, used for unique IDs.
+        managers (list): "Surname, Forename" names used in reportsTo.
+
+    Returns:
+        dict: The worker.
+    """
+    forename, surname = person_name(rng)
+    primary = rng.randrange(3)
+    assignments = []
+    for position in range(3):
+        assignments.append({
+            "itemID": f"{number}-{position}",
+            "primaryIndicator": position == primary,
+            "jobTitle": rng.choice(JOB_TITLES),
+            "hireDate": day(rng, 4000),
+            "assignmentStatus": {"statusCode": {"codeValue": "A", "shortName": "Active"}},
+            "reportsTo": (
+                [{"reportsToWorkerName": {"formattedName": rng.choice(managers)}, "associateOID": f"M{rng.randrange(10**8):08d}"}]
+                if rng.random() < 0.95 else []
+            ),
+            "homeOrganizationalUnits": [{"nameCode": {"codeValue": f"{rng.randrange(900):03d}", "shortName": rng.choice(CITIES)}, "typeCode": {"codeValue": "Department"}}],
+            "baseRemuneration": {"hourlyRateAmount": {"amountValue": round(rng.uniform(14, 45), 2), "currencyCode": "USD"}},
+        })
+
+    return {
+        "associateOID": f"G{number:011d}",
+        "workerID": {"idValue": f"W{number:07d}"},
+        "person": {
+            "legalName": {
+                "givenName": forename,
+                "middleName": rng.choice(FORENAMES) if rng.random() < 0.3 else None,
+                "familyName1": surname,
+                "formattedName": f"{surname}, {forename}",
+            },
+            "preferredName": {"givenName": rng.choice(FORENAMES)} if rng.random() < 0.2 else None,
+            "birthDate": day(rng, 65 * 365, 18 * 365),
+            "legalAddress": {
+                "lineOne": f"{rng.randint(1, 9999)} {rng.choice(STREETS)}",
+                "cityName": rng.choice(CITIES),
+                "postalCode": f"{rng.randrange(10**5):05d}",
+                "countrySubdivisionLevel1": {"codeValue": "TX"},
+            },
+            "communication": {
+                "emails": [{"emailUri": f"{forename}.{surname}{number}@example.com".lower(), "nameCode": {"codeValue": "Personal"}}],
+                "mobiles": [{"formattedNumber": f"({rng.randrange(200, 999)}) 555-{rng.randrange(10**4):04d}"}],
+            },
+        },
+        "workerStatus": {"statusCode": {"codeValue": rng.choice(WORKER_STATUSES)}},
+        "workerDates": {"originalHireDate": day(rng, 4000, 1)},
+        "workAssignments": assignments,
+        "customFieldGroup": {
+            "stringFields": [{"nameCode": {"codeValue": f"field{index}"}, "stringValue": rng.choice(CITIES)} for index in range(8)],
+        },
+    }
+
+def broken_worker(rng, number, managers):
+    """
+    A worker transform_staff dead-letters: no primary assignment, or a missing required block.
+    """
+    record = worker(rng, number, managers)
+    fault = rng.randrange(3)
+    if fault == 0:
+        for assignment in record["workAssignments"]:
+            assignment["primaryIndicator"] = False
+    elif fault == 1:
+        del record["workerDates"]
+    else:
+        del record["person"]["legalAddress"]
+    return record
+
+def requisition(rng, number):
+    """
+    One ADP job requisition, shaped like the /staffing/v1/job-requisitions records GET_reqs reads.
+
+    About one in ten has no postDate, and openings are either backfills, new positions or neither.
+    """
+    kind = rng.random()
+    posting = {"postingChannel": {"codeValue": "External"}}
+    if rng.random() < 0.9:
+        posting["postDate"] = f"{day(rng, 720, 30)}T{rng.randrange(24):02d}:00:00Z"
+    return {
+        "itemID": f"R{number:06d}",
+        "requisitionTitle": rng.choice(JOB_TITLES),
+        "postingInstructions": [posting],
+        "backfillWorkerPositions": [{"positionID": f"P{rng.randrange(10**6):06d}"}] if kind < 0.5 else [],
+        "openingsNewPositionQuantity": 1 if 0.5 <= kind < 0.9 else 0,
+        "requisitionStatusCode": {"codeValue": rng.choice(["Open", "Filled", "Closed"])},
+    }
+
+def application(rng, number, requisitions, managers, staff=None):
+    """
+    One ADP job application, shaped like the /staffing/v2/job-applications records GET_applicants_adp reads.
+
+    Args:
+        rng (random.Random): Source of randomness.
+        number (int): Position of the application, used for unique IDs.
+        requisitions (list): The generated requisitions, one is referenced.
+        managers (list): "Surname, Forename" names used as hiring managers.
+        staff (dict): A generated worker to base the applicant on, so some applicants match current staff.
+
+    Returns:
+        dict: The application.
+    """
+    requisition = rng.choice(requisitions)
+    if staff:
+        legal_name = staff["person"]["legalName"]
+        forename, surname = legal_name["givenName"], legal_name["familyName1"]
+        birth_date = staff["person"]["birthDate"]
+        effective_date = staff["workerDates"]["originalHireDate"]
+        status = "Hired"
+    else:
+        forename, surname = person_name(rng)
+        birth_date = day(rng, 65 * 365, 18 * 365) if rng.random() < 0.8 else ""
+        effective_date = day(rng, 720)
+        status = rng.choice(APPLICATION_STATUSES)
+
+    return {
+        "itemID": f"A{number:08d}",
+        "applicant": {
+            "person": {
+                "personName": {"givenName": forename, "familyName1": surname, "formattedName": f"{forename} {surname}"},
+                "birthDate": birth_date,
+                "address": {"lineOne": f"{rng.randint(1, 9999)} {rng.choice(STREETS)}", "cityName": rng.choice(CITIES)},
+                "communication": {"emails": [{"emailUri": f"{forename}.{surname}{number}@example.com".lower()}]},
+            },
+        },
+        "applicationStatusCode": {"codeValue": status.upper().replace(" ", "_"), "shortName": status, "effectiveDate": effective_date},
+        "jobRequisitionReference": {
+            "requisitionID": requisition["itemID"],
+            "requisitionTitle": requisition["requisitionTitle"],
+            "hiringManager": {"personName": {"formattedName": rng.choice(managers)}} if rng.random() < 0.97 else {},
+            "recruiter": {"personName": {"formattedName": rng.choice(RECRUITERS)}},
+        },
+        "questionnaireResponses": [{"questionID": f"Q{index}", "answer": rng.choice(["Yes", "No"])} for index in range(5)],
+    }
+
+def broken_application(rng, number, requisitions, managers):
+    """
+    An application transform_applications dead-letters: no address, or no requisition reference.
+    """
+    record = application(rng, number, requisitions, managers)
+    if rng.random() < 0.5:
+        del record["applicant"]["person"]["address"]
+    else:
+        del record["jobRequisitionReference"]
+    return record
+
+def generate(staff=5000, applications=200000, requisitions=10000, broken_rate=0.01, hired_rate=0.02, seed=0):
+    """
+    Generate the three ADP payloads at the given scale.
+
+    Args:
+        staff (int): Number of workers.
+        applications (int): Number of job applications.
+        requisitions (int): Number of job requisitions.
+        broken_rate (float): Share of workers and applications that end up as dead letters.
+        hired_rate (float): Share of applications copied from a worker, so they match in match_applicants.
+        seed (int): Seed, the same arguments always give the same payloads.
+
+    Returns:
+        dict: "workers", "jobApplications" and "jobRequisitions" lists of raw records.
+    """
+    rng = random.Random(seed)
+    managers = [f"{surname}, {forename}" for forename, surname in (person_name(rng) for _ in range(max(1, staff // 25)))]
+
+    workers, hired = [], []
+    for number in range(staff):
+        if rng.random() < broken_rate:
+            workers.append(broken_worker(rng, number, managers))
+        else:
+            workers.append(worker(rng, number, managers))
+            hired.append(workers[-1])
+    job_requisitions = [requisition(rng, number) for number in range(max(1, requisitions))]
+
+    job_applications = []
+    for number in range(applications):
+        roll = rng.random()
+        if roll < broken_rate:
+            job_applications.append(broken_application(rng, number, job_requisitions, managers))
+        elif roll < broken_rate + hired_rate and hired:
+            job_applications.append(application(rng, number, job_requisitions, managers, rng.choice(hired)))
+        else:
+            job_applications.append(application(rng, number, job_requisitions, managers))
+
+    return {"workers": workers, "jobApplications": job_applications, "jobRequisitions": job_requisitions[:requisitions]}
+
+ENDPOINTS = {                                       #records key -> ADP path and the $top GET_* uses
+    "workers": ("/hr/v2/workers", 100),
+    "jobApplications": ("/staffing/v2/job-applications", 20),
+    "jobRequisitions": ("/staffing/v1/job-requisitions", 20),
+}
+
+def write_recordings(payloads, folder):
+    """
+    Write generated payloads in the ExchangeRecorder format, so stand_in.py can serve them.
+    """
+    os.makedirs(folder, exist_ok=True)
+    for records_key, records in payloads.items():
+        path, page_size = ENDPOINTS[records_key]
+        with open(os.path.join(folder, f"{path.rsplit('/', 1)[-1]}.jsonl"), "w") as outfile:
+            for skip in range(0, len(records), page_size):
+                exchange = {
+                    "method": "GET",
+                    "path": path,
+                    "params": {"$top": str(page_size), "$skip": str(skip)},
+                    "status_code": 200,
+                    "headers": {"Content-Type": "application/json"},
+                    "body": {records_key: records[skip:skip + page_size]},
+                }
+                outfile.write(json.dumps(exchange) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic ADP payloads as stand_in.py recordings")
+    parser.add_argument("folder", help="where to write the recordings")
+    parser.add_argument("--staff", type=int, default=5000)
+    parser.add_argument("--applications", type=int, default=200000)
+    parser.add_argument("--requisitions", type=int, default=10000)
+    parser.add_argument("--broken-rate", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    payloads = generate(args.staff, args.applications, args.requisitions, args.broken_rate, seed=args.seed)
+    write_recordings(payloads, args.folder)
+    for records_key, records in payloads.items():
+        print(f"    {records_key:<20}{len(records):>8}")
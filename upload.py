@@ -59,6 +59,9 @@ IMAGE_NAME = "metrics"
 TAG = f"{REGION}-docker.pkg.dev/{PROJECT_ID}/{REPO}/{IMAGE_NAME}:latest"
 JOB_NAME = "usa-recruitment-dashboard"
 BUCKET_NAME = f"gcf-artifacts-{PROJECT_ID}"  # Must exist
+TASK_COUNT = 1  # Tasks sharing the ADP extraction, the last to finish does the BigQuery load
+STORE_BUCKET = ""  # Bucket mounted on the job for state that outlives a run and for shards (needed when TASK_COUNT > 1)
+STORE_MOUNT = "/mnt/store"
 SOURCE_TAR = "source.tar.gz"
 
 # Step 2: Package source code
@@ -118,6 +121,42 @@ def trigger_cloud_build(credentials, object_name):
     build_op = cloudbuild.projects().builds().create(projectId=PROJECT_ID, body=build_request).execute()
     print("✅ Cloud Build started. Build ID:", build_op["metadata"]["build"]["id"])
 
+# Step 5a: Apply the image, env vars, task count and storage volume to the job
+def configure_job(containers, execution=None, task=None):
+    """
+    execution and task are the v2 job's template and template.template. Other job shapes
+    only take the image and env vars, so sharding or a bucket on them fails here.
+    """
+    containers[0]["image"] = TAG
+
+    # ✅ Inject PROJECT_ID env var, and the store folders when a bucket is mounted
+    containers[0].setdefault("env", [])
+    env_vars = {env["name"]: env for env in containers[0]["env"]}
+    env_vars["PROJECT_ID"] = {"name": "PROJECT_ID", "value": PROJECT_ID}
+    if STORE_BUCKET:
+        env_vars["STATE_STORE"] = {"name": "STATE_STORE", "value": f"{STORE_MOUNT}/state"}
+        env_vars["SHARD_STORE"] = {"name": "SHARD_STORE", "value": f"{STORE_MOUNT}/shards"}
+    containers[0]["env"] = list(env_vars.values())
+
+    if TASK_COUNT == 1 and not STORE_BUCKET:
+        return
+    if execution is None or task is None:
+        raise Exception("❌ TASK_COUNT and STORE_BUCKET need the v2 job shape (template.template.containers)")
+
+    # ✅ Shard the extraction across TASK_COUNT tasks, all running at once
+    execution["taskCount"] = TASK_COUNT
+    execution["parallelism"] = TASK_COUNT
+
+    # ✅ Mount the bucket (Cloud Storage volumes need the second generation environment)
+    if STORE_BUCKET:
+        task["executionEnvironment"] = "EXECUTION_ENVIRONMENT_GEN2"
+        volumes = {volume["name"]: volume for volume in task.get("volumes", [])}
+        volumes["store"] = {"name": "store", "gcs": {"bucket": STORE_BUCKET, "readOnly": False}}
+        task["volumes"] = list(volumes.values())
+        mounts = {mount["name"]: mount for mount in containers[0].get("volumeMounts", [])}
+        mounts["store"] = {"name": "store", "mountPath": STORE_MOUNT}
+        containers[0]["volumeMounts"] = list(mounts.values())
+
 # Step 5: Update Job (without running)
 def update_job_only(credentials):
     run_client = build("run", "v2", credentials=credentials)
@@ -133,25 +172,13 @@ def update_job_only(credentials):
                     template = job["spec"]["template"]
                     if "spec" in template and "template" in template["spec"]:
                         containers = template["spec"]["template"]["spec"]["containers"]
-                        containers[0]["image"] = TAG
-
-                        # ✅ Inject PROJECT_ID env var
-                        containers[0].setdefault("env", [])
-                        env_vars = {env["name"]: env for env in containers[0]["env"]}
-                        env_vars["PROJECT_ID"] = {"name": "PROJECT_ID", "value": PROJECT_ID}
-                        containers[0]["env"] = list(env_vars.values())
+                        configure_job(containers)
 
                         updated = True
                         print("✅ Updated using v2 spec path")
                     elif "template" in template:
                         containers = template["template"]["spec"]["containers"]
-                        containers[0]["image"] = TAG
-
-                        # ✅ Inject PROJECT_ID env var
-                        containers[0].setdefault("env", [])
-                        env_vars = {env["name"]: env for env in containers[0]["env"]}
-                        env_vars["PROJECT_ID"] = {"name": "PROJECT_ID", "value": PROJECT_ID}
-                        containers[0]["env"] = list(env_vars.values())
+                        configure_job(containers)
 
                         updated = True
                         print("✅ Updated using alternative v2 spec path")
@@ -163,13 +190,7 @@ def update_job_only(credentials):
                 template = job["template"]
                 if "template" in template and "containers" in template["template"]:
                     containers = template["template"]["containers"]
-                    containers[0]["image"] = TAG
-
-                    # ✅ Inject PROJECT_ID env var
-                    containers[0].setdefault("env", [])
-                    env_vars = {env["name"]: env for env in containers[0]["env"]}
-                    env_vars["PROJECT_ID"] = {"name": "PROJECT_ID", "value": PROJECT_ID}
-                    containers[0]["env"] = list(env_vars.values())
+                    configure_job(containers, template, template["template"])
 
                     updated = True
                     print("✅ Updated using v1 template path")
@@ -208,25 +229,13 @@ def update_and_run_job(credentials):
                     template = job["spec"]["template"]
                     if "spec" in template and "template" in template["spec"]:
                         containers = template["spec"]["template"]["spec"]["containers"]
-                        containers[0]["image"] = TAG
-
-                        # ✅ Inject PROJECT_ID env var
-                        containers[0].setdefault("env", [])
-                        env_vars = {env["name"]: env for env in containers[0]["env"]}
-                        env_vars["PROJECT_ID"] = {"name": "PROJECT_ID", "value": PROJECT_ID}
-                        containers[0]["env"] = list(env_vars.values())
+                        configure_job(containers)
 
                         updated = True
                         print("✅ Updated using v2 spec path")
                     elif "template" in template:
                         containers = template["template"]["spec"]["containers"]
-                        containers[0]["image"] = TAG
-
-                        # ✅ Inject PROJECT_ID env var
-                        containers[0].setdefault("env", [])
-                        env_vars = {env["name"]: env for env in containers[0]["env"]}
-                        env_vars["PROJECT_ID"] = {"name": "PROJECT_ID", "value": PROJECT_ID}
-                        containers[0]["env"] = list(env_vars.values())
+                        configure_job(containers)
 
                         updated = True
                         print("✅ Updated using alternative v2 spec path")
@@ -238,13 +247,7 @@ def update_and_run_job(credentials):
                 template = job["template"]
                 if "template" in template and "containers" in template["template"]:
                     containers = template["template"]["containers"]
-                    containers[0]["image"] = TAG
-
-                    # ✅ Inject PROJECT_ID env var
-                    containers[0].setdefault("env", [])
-                    env_vars = {env["name"]: env for env in containers[0]["env"]}
-                    env_vars["PROJECT_ID"] = {"name": "PROJECT_ID", "value": PROJECT_ID}
-                    containers[0]["env"] = list(env_vars.values())
+                    configure_job(containers, template, template["template"])
 
                     updated = True
                     print("✅ Updated using v1 template path")
@@ -277,6 +280,9 @@ def update_and_run_job(credentials):
 
 
 if __name__ == "__main__":
+    if TASK_COUNT > 1 and not STORE_BUCKET:
+        raise Exception("❌ TASK_COUNT > 1 needs STORE_BUCKET, each task has a disk of its own")
+
     try:
         create_tarball()
         object_name = upload_source(credentials)